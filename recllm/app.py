@@ -1,12 +1,26 @@
-from typing import List, Dict
-from fastapi import FastAPI, HTTPException
+from typing import List, Dict, AsyncIterator, Optional, Tuple
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, field_validator
 from recllm.models.rec_llm import RecLLM
+from recllm.models.user_profile import UserProfile
+from recllm.models.scheduler import InferenceScheduler
+from recllm.models.output_cache import OutputCache
 from recllm.utils.youtube_api import YouTubeAPI
+from recllm.utils.video_index import VideoIndex
+from recllm.utils.response_cache import ResponseCache
 from recllm.utils.profile_store import ProfileStore
+from recllm.utils.feedback_queue import FeedbackQueue
+from recllm.utils.executors import INFERENCE_EXECUTOR, run_inference, run_io, shutdown_executors
+from recllm.utils.metrics import REGISTRY, REQUEST_SECONDS, server_timing, track_request
 from dotenv import load_dotenv
 from huggingface_hub import login
 import os
+import json
+import time
+import asyncio
+import threading
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
@@ -18,10 +32,133 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Login to Hugging Face
-login(token=os.getenv("HUGGING_FACE_HUB_TOKEN"))
+# Services are built by the lifespan handler, off the event loop, rather than
+# at import time: importing the app is cheap and / answers while the model
+# loads. /ready reports when requests can actually be served.
+rec_llm: Optional[RecLLM] = None
+youtube_api: Optional[YouTubeAPI] = None
+profile_store: Optional[ProfileStore] = None
+feedback_queue: Optional[FeedbackQueue] = None
+_ready = threading.Event()
+_startup_error: Optional[str] = None
+_startup_task: Optional[asyncio.Task] = None
+# Per-stage durations of each request in a Server-Timing response header
+SERVER_TIMING = os.getenv("RECLLM_SERVER_TIMING", "0") == "1"
+# Profile aspects and search queries from one planning generation instead of two
+FUSED_PLANNING = os.getenv("RECLLM_FUSED_PLANNING", "0") == "1"
+# Search results per request, split between the planned queries
+SEARCH_RESULTS = 10
 
-app = FastAPI()
+def load_model() -> RecLLM:
+    """Load the model weights, logging in to Hugging Face first if a token is set."""
+    token = os.getenv("HUGGING_FACE_HUB_TOKEN")
+    if token:
+        # Login to Hugging Face
+        login(token=token)
+
+    return RecLLM(model_name=os.getenv("RECLLM_MODEL", "google/gemma-2b-it"))
+
+def load_services(model: Optional[RecLLM] = None):
+    """Build every service from environment configuration and warm the model up.
+
+    A model already returned by load_model(), e.g. one inherited by forked
+    workers, is reused; caches, threads and connections are created here so
+    that each process gets its own.
+    """
+    if model is None:
+        model = load_model()
+    if os.getenv("RECLLM_OUTPUT_CACHE", "1") == "1":
+        model.output_cache = OutputCache(
+            # Outputs differ between precisions, and the disk tier outlives restarts
+            f"{model.model_name}@{model.precision}",
+            disk_path=os.getenv("RECLLM_OUTPUT_CACHE_PATH") or None
+        )
+    if os.getenv("RECLLM_BATCH_SCHEDULER", "0") == "1":
+        model.scheduler = InferenceScheduler(
+            model,
+            max_batch_size=int(os.getenv("RECLLM_MAX_BATCH_SIZE", "8")),
+            max_wait_ms=float(os.getenv("RECLLM_MAX_BATCH_WAIT_MS", "10"))
+        )
+
+    model.warmup()
+    configure(model, build_youtube_api(), ProfileStore.from_env())
+
+def build_youtube_api() -> YouTubeAPI:
+    """YouTube client with search and video caches configured from the environment."""
+    youtube_cache_path = os.getenv("RECLLM_YOUTUBE_CACHE", "/tmp/youtube_cache.sqlite") or None
+    return YouTubeAPI(
+        search_cache=ResponseCache(
+            "search",
+            ttl_seconds=float(os.getenv("RECLLM_SEARCH_CACHE_TTL", str(6 * 3600))),
+            max_stale_seconds=float(os.getenv("RECLLM_CACHE_MAX_STALE", str(24 * 3600))),
+            disk_path=youtube_cache_path
+        ),
+        video_cache=ResponseCache(
+            "videos",
+            ttl_seconds=float(os.getenv("RECLLM_VIDEO_CACHE_TTL", str(24 * 3600))),
+            max_entries=8192,
+            max_stale_seconds=float(os.getenv("RECLLM_CACHE_MAX_STALE", str(24 * 3600))),
+            disk_path=youtube_cache_path
+        ),
+        video_index=VideoIndex(
+            os.getenv("RECLLM_VIDEO_INDEX", "/tmp/video_index.sqlite") or None,
+            max_videos=int(os.getenv("RECLLM_VIDEO_INDEX_SIZE", "50000"))
+        ),
+        retrieval_mode=os.getenv("RECLLM_RETRIEVAL_MODE", "api"),
+        local_results=int(os.environ["RECLLM_LOCAL_RESULTS"]) if os.getenv("RECLLM_LOCAL_RESULTS") else None,
+        quota_cooldown_seconds=float(os.getenv("RECLLM_QUOTA_COOLDOWN", "3600"))
+    )
+
+def configure(model: RecLLM, youtube: YouTubeAPI, store: ProfileStore):
+    """Install the services used by the endpoints and mark the app ready."""
+    global rec_llm, youtube_api, profile_store, feedback_queue
+    rec_llm, youtube_api, profile_store = model, youtube, store
+    # Feedback is applied to profiles in the background
+    feedback_queue = FeedbackQueue(
+        rec_llm,
+        profile_store,
+        window_seconds=float(os.getenv("RECLLM_FEEDBACK_WINDOW", "2")),
+        executor=INFERENCE_EXECUTOR
+    )
+    _ready.set()
+
+async def _load_in_background():
+    global _startup_error
+    try:
+        await run_inference(load_services)
+        logger.info("RecLLM services ready")
+    except Exception as e:
+        _startup_error = str(e)
+        logger.error(f"Error loading services: {str(e)}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _startup_task
+    # Services may already have been installed with configure(), e.g. by benchmarks
+    if not _ready.is_set():
+        _startup_task = asyncio.create_task(_load_in_background())
+    yield
+    if _startup_task is not None:
+        # Stops waiting for a load still in progress; the executor thread
+        # running it finishes before shutdown_executors() returns
+        _startup_task.cancel()
+        try:
+            await _startup_task
+        except asyncio.CancelledError:
+            pass
+        _startup_task = None
+    # Drain queued feedback before the store flushes its pending writes
+    if feedback_queue is not None:
+        feedback_queue.close()
+    if profile_store is not None:
+        profile_store.close()
+    shutdown_executors()
+
+def _require_ready():
+    if not _ready.is_set():
+        raise HTTPException(status_code=503, detail=_startup_error or "RecLLM is starting")
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -31,11 +168,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-rec_llm = RecLLM(model_name="google/gemma-2b-it")
-youtube_api = YouTubeAPI()
-
-# Initialize profile store
-profile_store = ProfileStore()
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Time each request and collect the durations of the stages it ran."""
+    started = time.perf_counter()
+    with track_request() as timings:
+        response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        route=route.path if route is not None else "unmatched",
+        status=str(response.status_code)
+    )
+    # Streamed responses start before their later stages run, so only earlier stages appear
+    if SERVER_TIMING and timings:
+        response.headers["Server-Timing"] = server_timing(timings)
+    return response
 
 class Message(BaseModel):
     role: str
@@ -64,100 +212,233 @@ class RecommendationResponse(BaseModel):
     recommendations: List[Dict]
     explanation: str
 
-@app.post("/api/chat", response_model=RecommendationResponse)
-async def chat_endpoint(request: ConversationRequest) -> RecommendationResponse:
-    """Handle chat messages and return personalised video recommendations."""
-    try:
-        # Get or create user profile using profile store
-        user_profile = profile_store.get_profile(request.user_id)
+async def _recommend(request: ConversationRequest) -> Tuple[UserProfile, List[Dict], str, List[Dict]]:
+    """Run the pipeline up to ranking: profile aspects, search query, retrieval and ranking.
 
-        # Extract profile aspects relevant to current conversation context
-        conversation_context = "\n".join(
-            [f"{msg.role}: {msg.content}" for msg in request.messages]
+    With fused planning, the aspects and up to three search queries come
+    from a single generation and the queries are searched concurrently.
+
+    Model calls go through the inference executor and YouTube/profile I/O
+    through the I/O pool, so the event loop stays free for other requests.
+    """
+    # Get or create user profile using profile store
+    user_profile = await run_io(profile_store.get_profile, request.user_id)
+
+    # Convert Pydantic models to dictionaries for the LLM functions
+    messages_dict = [
+        {"role": msg.role, "content": msg.content}
+        for msg in request.messages
+    ]
+
+    search_queries = []
+    if FUSED_PLANNING:
+        relevant_profile, search_queries = await run_inference(
+            rec_llm.plan,
+            messages_dict,
+            user_profile.prompt_description(rec_llm),
+            session_id=request.user_id,
+            cache_tag=user_profile.cache_tag
         )
-        relevant_profile = user_profile.get_relevant_profile_aspects(
-            conversation_context,
+        relevant_profile = relevant_profile or user_profile.prompt_description(rec_llm)
+    else:
+        # Extract profile aspects relevant to current conversation context
+        relevant_profile = await run_inference(
+            user_profile.get_relevant_profile_aspects,
+            rec_llm.format_conversation(messages_dict, stage="profile_aspects", session_id=request.user_id),
             rec_llm
         )
 
-        # Convert Pydantic models to dictionaries for the LLM functions
-        messages_dict = [
-            {"role": msg.role, "content": msg.content}
-            for msg in request.messages
-        ]
-
+    if not search_queries:
         # Generate contextual search query
-        search_query = rec_llm.generate_search_query(
+        search_queries = [await run_inference(
+            rec_llm.generate_search_query,
             messages_dict,
-            relevant_profile
-        )
-        
-        # Retrieve + Rank candidate videos
-        video_candidates = youtube_api.search_videos(search_query)
-        ranked_videos = rec_llm.rank_videos(
-            video_candidates,
-            conversation_context,
-            relevant_profile
-        )
+            relevant_profile,
+            session_id=request.user_id,
+            cache_tag=user_profile.cache_tag
+        )]
+
+    # Retrieve + Rank candidate videos
+    video_candidates = _interleave(await run_io(
+        youtube_api.search_videos_many,
+        search_queries,
+        max_results=max(1, SEARCH_RESULTS // len(search_queries))
+    ))
+    ranked_videos = await run_inference(
+        rec_llm.rank_videos,
+        video_candidates,
+        rec_llm.format_conversation(messages_dict, stage="ranking", session_id=request.user_id),
+        relevant_profile,
+        top_k=5,
+        session_id=request.user_id,
+        cache_tag=user_profile.cache_tag
+    )
+
+    return user_profile, messages_dict, relevant_profile, ranked_videos
+
+async def _compact_and_save(user_id: str, user_profile: UserProfile):
+    """Re-summarise the profile description if it is over budget, then save the profile."""
+    await run_inference(user_profile.compact, rec_llm)
+    await run_io(profile_store.save_profile, user_id, user_profile)
+
+def _interleave(results: List[List[Dict]]) -> List[Dict]:
+    """Merge the results of several searches round-robin, dropping repeated videos."""
+    merged = {}
+    for rank in range(max((len(videos) for videos in results), default=0)):
+        for videos in results:
+            if rank < len(videos):
+                merged.setdefault(videos[rank]["id"], videos[rank])
+    return list(merged.values())
+
+def _explain(ranked_videos: List[Dict]) -> str:
+    """Summarise why the top recommendations were chosen."""
+    explanation = "Here's why I recommended these videos:\n"
+    for video in ranked_videos[:3]:
+        explanation += f"\n{video['title']}: {video['explanation']}"
+    return explanation
+
+def _sse(event: str, data: Dict) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/api/chat", response_model=RecommendationResponse, dependencies=[Depends(_require_ready)])
+async def chat_endpoint(
+    request: ConversationRequest,
+    background_tasks: BackgroundTasks
+) -> RecommendationResponse:
+    """Handle chat messages and return personalised video recommendations."""
+    try:
+        user_profile, messages_dict, relevant_profile, ranked_videos = await _recommend(request)
 
         # Generate response
-        response = rec_llm.generate_recommendation_response(
+        response = await run_inference(
+            rec_llm.generate_recommendation_response,
             messages_dict,
             ranked_videos,
-            relevant_profile
+            relevant_profile,
+            session_id=request.user_id
         )
 
-        explanation = "Here's why I recommended these videos:\n"
-        for video in ranked_videos[:3]:
-            explanation += f"\n{video['title']}: {video['explanation']}"
-
-        # Save profile after updates
-        profile_store.save_profile(request.user_id, user_profile)
+        # Save profile after the response has been sent
+        background_tasks.add_task(_compact_and_save, request.user_id, user_profile)
         
         return RecommendationResponse(
             response=response,
             recommendations=ranked_videos[:5],
-            explanation=explanation
+            explanation=_explain(ranked_videos)
         )
 
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/feedback")
+@app.post("/api/chat/stream", dependencies=[Depends(_require_ready)])
+async def chat_stream_endpoint(request: ConversationRequest) -> StreamingResponse:
+    """Stream recommendations as soon as they are ranked, then the response tokens, over SSE.
+
+    Events: `recommendations` (ranked videos and explanation), `token` (one
+    chunk of response text), `done` (the full response) or `error`.
+    """
+    # Run once the stream has ended, so the response is not held open for them
+    background = BackgroundTasks()
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            user_profile, messages_dict, relevant_profile, ranked_videos = await _recommend(request)
+            yield _sse("recommendations", {
+                "recommendations": ranked_videos[:5],
+                "explanation": _explain(ranked_videos)
+            })
+
+            stream = rec_llm.stream_recommendation_response(
+                messages_dict,
+                ranked_videos,
+                relevant_profile,
+                session_id=request.user_id,
+                executor=INFERENCE_EXECUTOR
+            )
+            chunks = []
+            # Waiting on the streamer blocks, so each chunk is pulled on the I/O pool
+            while (text := await run_io(next, stream, None)) is not None:
+                chunks.append(text)
+                yield _sse("token", {"text": text})
+
+            yield _sse("done", {"response": "".join(chunks).strip()})
+
+            # Save profile after the response has been sent
+            background.add_task(_compact_and_save, request.user_id, user_profile)
+
+        except Exception as e:
+            logger.error(f"Error in chat stream endpoint: {str(e)}", exc_info=True)
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background
+    )
+
+@app.post("/api/feedback", dependencies=[Depends(_require_ready)])
 async def feedback_endpoint(
     user_id: str,
     video_id: str,
     feedback_type: str,
-    feedback_value: float
+    feedback_value: float,
+    background_tasks: BackgroundTasks
 ) -> Dict[str, str]:
-    """Handle user feedback and update user profile accordingly."""
+    """Record user feedback and queue the profile update.
+
+    The watch history is updated right away; the LLM profile update runs in
+    the background feedback queue, coalesced with the user's other recent
+    feedback, so the response does not wait for it.
+    """
     try:
-        user_profile = profile_store.get_profile(user_id)
-        
-        video_details = youtube_api.get_video_details(video_id)
+        # Profile load and the YouTube lookup are independent, so overlap them
+        user_profile, video_details = await asyncio.gather(
+            run_io(profile_store.get_profile, user_id),
+            run_io(youtube_api.get_video_details, video_id)
+        )
         
         if video_details:
             # Record video in user's watch history
             user_profile.add_to_watch_history(video_details)
             
             # Update profile based on feedback
-            user_profile.update_profile_from_feedback(
-                video_details,
-                feedback_type,
-                feedback_value,
-                rec_llm
-            )
+            feedback_queue.submit(user_id, video_details, feedback_type, feedback_value)
             
-        # Save profile after updates
-        profile_store.save_profile(user_id, user_profile)
+        # Save profile after the response has been sent
+        background_tasks.add_task(run_io, profile_store.save_profile, user_id, user_profile)
             
-        return {"status": "success"}
+        return {"status": "accepted"}
         
     except Exception as e:
         logger.error(f"Error in feedback endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/stats", dependencies=[Depends(_require_ready)])
+async def stats_endpoint() -> Dict[str, Dict]:
+    """Report inference cache and batching statistics."""
+    return {
+        "prefix_cache": rec_llm.prefix_cache.stats() if rec_llm.prefix_cache else {},
+        "scheduler": rec_llm.scheduler.stats() if rec_llm.scheduler else {},
+        "output_cache": rec_llm.output_cache.stats() if rec_llm.output_cache else {},
+        "assisted_decoding": rec_llm.assisted_stats(),
+        "youtube_cache": youtube_api.cache_stats(),
+        "feedback_queue": feedback_queue.stats()
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint() -> PlainTextResponse:
+    """Stage latency, token, cache and YouTube API metrics in the Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before."""
+    _require_ready()
+    return {"status": "ready"}
+
 @app.get("/")
 async def root():
     return {"message": "RecLLM API is running"}
@@ -0,0 +1,155 @@
+"""Precompute recommendations for many users offline.
+
+Reads one user per line from a JSONL file, {"user_id": ..., "messages":
+[{"role": ..., "content": ...}, ...]}, and appends one result per user to
+the output JSONL file: the search query and the ranked recommendations.
+
+    python -m recllm.batch users.jsonl recommendations.jsonl --chunk-size 64
+
+Users are processed in chunks: search queries are generated in batches,
+identical queries are searched once, video details are shared through the
+YouTube cache, and candidates are ranked in batched forward passes. Each
+chunk is flushed to the output before the next starts, so an interrupted
+run resumes where it stopped when started again with the same output.
+Profiles are loaded from the configured ProfileStore and their stored
+description, cut to the profile token budget, is used as is; the
+per-request profile aspect extraction is skipped.
+"""
+from typing import Dict, Iterator, List, Set
+import argparse
+import json
+import logging
+import os
+import time
+from recllm.app import build_youtube_api, load_model
+from recllm.models.rec_llm import RecLLM
+from recllm.utils.youtube_api import YouTubeAPI
+from recllm.utils.profile_store import ProfileStore
+
+logger = logging.getLogger(__name__)
+
+
+def completed_users(output_path: str) -> Set[str]:
+    """User ids already written to the output, dropping a partially written last line."""
+    if not os.path.exists(output_path):
+        return set()
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # A crash mid-write leaves an incomplete line behind
+            f.truncate(end)
+
+    return {
+        json.loads(line)["user_id"]
+        for line in data[:end].decode("utf-8").splitlines() if line.strip()
+    }
+
+
+def read_users(input_path: str, skip: Set[str]) -> Iterator[Dict]:
+    with open(input_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            user = json.loads(line)
+            if user["user_id"] not in skip:
+                yield user
+
+
+def chunked(users: Iterator[Dict], size: int) -> Iterator[List[Dict]]:
+    chunk = []
+    for user in users:
+        chunk.append(user)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def recommend_chunk(
+    users: List[Dict],
+    rec_llm: RecLLM,
+    youtube_api: YouTubeAPI,
+    profile_store: ProfileStore,
+    top_k: int,
+    max_results: int,
+    batch_size: int
+) -> List[Dict]:
+    """Run query generation, retrieval and ranking for a chunk of users."""
+    profiles = [profile_store.get_profile(user["user_id"]).prompt_description(rec_llm) for user in users]
+    queries = rec_llm.generate_search_queries(
+        [user["messages"] for user in users],
+        profiles,
+        batch_size=batch_size
+    )
+
+    # Users with the same query share one search
+    unique_queries = list(dict.fromkeys(queries))
+    results = dict(zip(
+        unique_queries,
+        youtube_api.search_videos_many(unique_queries, max_results=max_results)
+    ))
+
+    outputs = []
+    for user, profile, query in zip(users, profiles, queries):
+        ranked = rec_llm.rank_videos(
+            results[query],
+            rec_llm.format_conversation(user["messages"], stage="ranking"),
+            profile,
+            top_k=top_k,
+            batch_size=batch_size
+        )
+        outputs.append({
+            "user_id": user["user_id"],
+            "search_query": query,
+            "recommendations": ranked
+        })
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL of users and seed conversations")
+    parser.add_argument("output", help="JSONL of recommendations; appended to and resumed from")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Users per checkpointed chunk")
+    parser.add_argument("--batch-size", type=int, default=16, help="Prompts per model batch")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--max-results", type=int, default=10, help="Search results per query")
+    args = parser.parse_args()
+
+    done = completed_users(args.output)
+    if done:
+        logger.info(f"Resuming: {len(done)} users already in {args.output}")
+
+    rec_llm = load_model()
+    youtube_api = build_youtube_api()
+    profile_store = ProfileStore.from_env()
+
+    processed, started = 0, time.perf_counter()
+    try:
+        with open(args.output, "a") as out:
+            for users in chunked(read_users(args.input, done), args.chunk_size):
+                for result in recommend_chunk(
+                    users,
+                    rec_llm,
+                    youtube_api,
+                    profile_store,
+                    top_k=args.top_k,
+                    max_results=args.max_results,
+                    batch_size=args.batch_size
+                ):
+                    out.write(json.dumps(result) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+
+                processed += len(users)
+                elapsed = time.perf_counter() - started
+                logger.info(f"{processed} users in {elapsed:.0f}s ({processed / elapsed:.2f} users/s)")
+    finally:
+        profile_store.close()
+
+
+if __name__ == "__main__":
+    main()
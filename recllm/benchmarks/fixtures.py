@@ -0,0 +1,90 @@
+"""Fixed conversations and videos for offline benchmarks and comparisons."""
+
+CONVERSATION = [
+    {"role": "user", "content": "I want to finally understand quantum computing."},
+    {"role": "assistant", "content": "Happy to help! Do you prefer short explainers or in-depth lectures?"},
+    {"role": "user", "content": "Something beginner friendly with good visuals, around 15 minutes."}
+]
+
+PROFILE_DESCRIPTION = (
+    "Enjoys visual, well-produced science explainers. Prefers videos between "
+    "10 and 20 minutes that build intuition before introducing maths."
+)
+
+RELEVANT_PROFILE = (
+    "Beginner in the topic; likes animated explanations and a calm pace; "
+    "avoids long lectures."
+)
+
+VIDEOS = [
+    {
+        "id": "fx-qc-intro",
+        "title": "Quantum Computing Explained Visually",
+        "description": "An animated introduction to qubits, superposition and entanglement for complete beginners.",
+        "channel_title": "Visual Science",
+        "duration": "PT14M32S",
+    },
+    {
+        "id": "fx-qc-lecture",
+        "title": "Lecture 1: Quantum Information Theory",
+        "description": "Full university lecture covering Hilbert spaces, density matrices and quantum channels.",
+        "channel_title": "University Open Courses",
+        "duration": "PT1H22M10S",
+    },
+    {
+        "id": "fx-qc-shor",
+        "title": "How Shor's Algorithm Breaks RSA",
+        "description": "A step-by-step walk through period finding and the quantum Fourier transform.",
+        "channel_title": "Math Unpacked",
+        "duration": "PT21M05S",
+    },
+    {
+        "id": "fx-qc-hype",
+        "title": "Quantum Computers Will Change EVERYTHING",
+        "description": "Reacting to the latest headlines about quantum supremacy and what it means for the future.",
+        "channel_title": "Tech Hype Daily",
+        "duration": "PT9M48S",
+    },
+    {
+        "id": "fx-cooking",
+        "title": "15 Minute Weeknight Pasta",
+        "description": "A quick and easy pasta recipe with garlic, chilli and lemon.",
+        "channel_title": "Home Kitchen",
+        "duration": "PT15M00S",
+    },
+    {
+        "id": "fx-qc-qubits",
+        "title": "What Is a Qubit, Really?",
+        "description": "Building intuition for qubits with the Bloch sphere and simple animations.",
+        "channel_title": "Visual Science",
+        "duration": "PT12M20S",
+    },
+    {
+        "id": "fx-classical-bits",
+        "title": "How Computers Work: Bits and Logic Gates",
+        "description": "From transistors to logic gates, a beginner's guide to classical computing.",
+        "channel_title": "Crash Courses",
+        "duration": "PT11M02S",
+    },
+    {
+        "id": "fx-qc-hardware",
+        "title": "Inside a Quantum Computer Lab",
+        "description": "A tour of superconducting qubit hardware, dilution refrigerators and control electronics.",
+        "channel_title": "Lab Tours",
+        "duration": "PT17M41S",
+    },
+    {
+        "id": "fx-football",
+        "title": "Top 10 Goals of the Season",
+        "description": "The best goals from this season's league matches.",
+        "channel_title": "Sports Highlights",
+        "duration": "PT8M15S",
+    },
+    {
+        "id": "fx-qc-python",
+        "title": "Programming a Quantum Computer in Python",
+        "description": "Hands-on tutorial writing your first quantum circuits with an open-source SDK.",
+        "channel_title": "Code Along",
+        "duration": "PT24M30S",
+    },
+]
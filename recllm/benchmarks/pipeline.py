@@ -0,0 +1,381 @@
+"""Offline end-to-end benchmark of the recommendation pipeline.
+
+Runs chat_endpoint and feedback_endpoint against a tiny randomly
+initialised causal LM and a fake YouTube client serving the fixture
+videos, so no Hugging Face token or YouTube key is needed. Reports
+per-stage latency percentiles, generated tokens/sec, peak RSS and
+request throughput for each number of concurrent clients:
+
+    python -m recllm.benchmarks.pipeline --clients 1 4 8 --requests 5 --output bench.json
+    python -m recllm.benchmarks.pipeline --baseline bench.json
+
+Latencies of a random model say nothing about output quality; they are
+meant for comparing runs of this harness against each other.
+"""
+from typing import Callable, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import tempfile
+import threading
+import time
+import torch
+from fastapi import BackgroundTasks
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from recllm import app as server
+from recllm.models.rec_llm import RecLLM
+from recllm.prompts import templates
+from recllm.utils.youtube_api import YouTubeAPI
+from recllm.utils.profile_store import JSONFileBackend, ProfileStore
+from recllm.utils.executors import shutdown_executors
+from recllm.benchmarks.fixtures import CONVERSATION, PROFILE_DESCRIPTION, RELEVANT_PROFILE, VIDEOS
+from recllm.benchmarks.precision import peak_rss_mb
+
+SPECIAL_TOKENS = ["<pad>", "<bos>", "<eos>"]
+
+
+def build_tokenizer(vocab_size: int = 1024) -> PreTrainedTokenizerFast:
+    """Train a small byte-level BPE tokenizer on the prompt templates and fixtures.
+
+    Digits and punctuation are kept as single tokens, as in the tokenizers
+    RecLLM's score reading is written for.
+    """
+    corpus = [
+        value for name, value in vars(templates).items()
+        if name.isupper() and isinstance(value, str)
+    ]
+    corpus += [PROFILE_DESCRIPTION, RELEVANT_PROFILE]
+    corpus += [msg["content"] for msg in CONVERSATION]
+    corpus += [f"{video['title']}\n{video['description']}\n{video['channel_title']}" for video in VIDEOS]
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Digits(individual_digits=True),
+        pre_tokenizers.Punctuation(),
+        pre_tokenizers.ByteLevel(add_prefix_space=False)
+    ])
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        bos_token="<bos>",
+        eos_token="<eos>"
+    )
+
+
+def build_model(vocab_size: int, hidden_size: int, layers: int) -> LlamaForCausalLM:
+    """A randomly initialised Llama-style causal LM of the given size."""
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        pad_token_id=0,
+        bos_token_id=1,
+        eos_token_id=2
+    )
+    return LlamaForCausalLM(config)
+
+
+class _FakeRequest:
+    def __init__(self, response: Dict, latency_seconds: float):
+        self.response = response
+        self.latency_seconds = latency_seconds
+
+    def execute(self) -> Dict:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return self.response
+
+
+class _FakeResource:
+    def __init__(self, handler: Callable[..., Dict], latency_seconds: float):
+        self.handler = handler
+        self.latency_seconds = latency_seconds
+
+    def list(self, **params) -> _FakeRequest:
+        return _FakeRequest(self.handler(**params), self.latency_seconds)
+
+
+class FakeYouTubeClient:
+    """Stands in for the discovery client, answering search and videos calls from fixtures.
+
+    Each call sleeps for latency_ms to stand in for the network round trip.
+    """
+
+    def __init__(self, videos: List[Dict] = VIDEOS, latency_ms: float = 0.0):
+        self.fixtures = {video["id"]: video for video in videos}
+        self.latency_seconds = latency_ms / 1000
+        self.calls = {"search": 0, "videos": 0}
+        self._lock = threading.Lock()
+
+    def search(self) -> _FakeResource:
+        return _FakeResource(self._search, self.latency_seconds)
+
+    def videos(self) -> _FakeResource:
+        return _FakeResource(self._videos, self.latency_seconds)
+
+    def _search(self, q: str, maxResults: int = 10, **params) -> Dict:
+        self._count("search")
+        return {"items": [
+            {"id": {"videoId": video_id}} for video_id in list(self.fixtures)[:maxResults]
+        ]}
+
+    def _videos(self, id: str, **params) -> Dict:
+        self._count("videos")
+        return {"items": [
+            self._raw_video(self.fixtures[video_id])
+            for video_id in id.split(",") if video_id in self.fixtures
+        ]}
+
+    def _count(self, resource: str):
+        with self._lock:
+            self.calls[resource] += 1
+
+    @staticmethod
+    def _raw_video(video: Dict) -> Dict:
+        """Render a fixture video as a videos().list item."""
+        return {
+            "id": video["id"],
+            "snippet": {
+                "title": video["title"],
+                "description": video["description"],
+                "thumbnails": {"medium": {"url": f"https://i.ytimg.com/vi/{video['id']}/mqdefault.jpg"}},
+                "channelTitle": video["channel_title"],
+                "publishedAt": "2024-01-01T00:00:00Z"
+            },
+            "statistics": {"viewCount": "1000", "likeCount": "100"},
+            "contentDetails": {"duration": video["duration"]}
+        }
+
+
+class StageRecorder:
+    """Collects wall-clock durations per stage and generate() token counts."""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+        self.generated_tokens = 0
+        self.prompt_tokens = 0
+        self.generate_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, obj, method: str, stage: Optional[str] = None):
+        """Replace obj.method with a timed version; without a stage, time under its stage kwarg."""
+        original = getattr(obj, method)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(stage or kwargs.get("stage", method), time.perf_counter() - started)
+
+        setattr(obj, method, timed)
+
+    def wrap_generate(self, model):
+        """Count prompt and new tokens of every model.generate() call."""
+        original = model.generate
+
+        def generate(*args, **kwargs):
+            input_ids = kwargs.get("input_ids", args[0] if args else None)
+            attention_mask = kwargs.get("attention_mask")
+            started = time.perf_counter()
+            outputs = original(*args, **kwargs)
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.generate_seconds += elapsed
+                self.prompt_tokens += int(
+                    attention_mask.sum() if attention_mask is not None else input_ids.numel()
+                )
+                self.generated_tokens += (outputs.shape[1] - input_ids.shape[1]) * outputs.shape[0]
+            return outputs
+
+        model.generate = generate
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "stages": {stage: latency_summary(values) for stage, values in self.durations.items()},
+                "prompt_tokens": self.prompt_tokens,
+                "generated_tokens": self.generated_tokens,
+                "generated_tokens_per_second": (
+                    self.generated_tokens / self.generate_seconds if self.generate_seconds else 0.0
+                )
+            }
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of values, q in [0, 100]."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99)
+    }
+
+
+async def _client(client_id: int, requests: int, recorder: StageRecorder):
+    """One simulated user: a chat request followed by feedback on the top recommendation."""
+    user_id = f"bench-{client_id}"
+    request = server.ConversationRequest(user_id=user_id, messages=CONVERSATION)
+    for _ in range(requests):
+        started = time.perf_counter()
+        background_tasks = BackgroundTasks()
+        result = await server.chat_endpoint(request, background_tasks)
+        await background_tasks()
+        recorder.record("chat_endpoint", time.perf_counter() - started)
+
+        video_id = result.recommendations[0]["id"] if result.recommendations else VIDEOS[0]["id"]
+        started = time.perf_counter()
+        background_tasks = BackgroundTasks()
+        await server.feedback_endpoint(user_id, video_id, "like", 1.0, background_tasks)
+        await background_tasks()
+        recorder.record("feedback_endpoint", time.perf_counter() - started)
+
+
+def run_round(
+    model: RecLLM,
+    youtube_client: FakeYouTubeClient,
+    profile_dir: str,
+    clients: int,
+    requests: int
+) -> Dict:
+    """Serve clients * requests chat + feedback pairs concurrently and summarise them."""
+    recorder = StageRecorder()
+    youtube = YouTubeAPI(client=youtube_client)
+    store = ProfileStore(backend=JSONFileBackend(profile_dir))
+    # Stage timings wrap the per-round service instances only
+    for method, stage in [
+        ("generate_response", None),
+        ("generate_search_query", "search_query"),
+        ("plan", "planning"),
+        ("rank_videos", "ranking"),
+        ("generate_recommendation_response", "response")
+    ]:
+        recorder.wrap(model, method, stage)
+    recorder.wrap(youtube, "search_videos", "youtube_search")
+    recorder.wrap(youtube, "get_video_details", "youtube_video_details")
+    recorder.wrap(store, "get_profile", "profile_load")
+    recorder.wrap(store, "save_profile", "profile_save")
+    recorder.wrap_generate(model.model)
+
+    server.configure(model, youtube, store)
+
+    async def run_clients():
+        await asyncio.gather(*[_client(i, requests, recorder) for i in range(clients)])
+
+    started = time.perf_counter()
+    asyncio.run(run_clients())
+    wall_seconds = time.perf_counter() - started
+    # Drain the background profile updates so their stage timings are included
+    server.feedback_queue.close()
+    store.close()
+
+    # Drop the instance-level wrappers so the next round starts from the plain methods
+    for method in ["generate_response", "generate_search_query", "plan", "rank_videos", "generate_recommendation_response"]:
+        delattr(model, method)
+    delattr(model.model, "generate")
+
+    return {
+        "clients": clients,
+        "requests_per_client": requests,
+        "wall_seconds": wall_seconds,
+        "chat_requests_per_second": clients * requests / wall_seconds,
+        **recorder.summary()
+    }
+
+
+def compare(results: Dict, baseline: Dict):
+    """Print the p50 change of every stage against a previous run."""
+    baseline_rounds = {result["clients"]: result for result in baseline["rounds"]}
+    for result in results["rounds"]:
+        previous = baseline_rounds.get(result["clients"])
+        if previous is None:
+            continue
+        print(f"\nclients={result['clients']} vs baseline")
+        for stage, summary in sorted(result["stages"].items()):
+            if stage in previous["stages"]:
+                before = previous["stages"][stage]["p50"]
+                print(f"  {stage:<24} p50 {before * 1000:>9.1f} -> {summary['p50'] * 1000:>9.1f} ms "
+                      f"({(summary['p50'] / before - 1) * 100:+.0f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--requests", type=int, default=3, help="Chat + feedback pairs per client")
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="Simulated YouTube round trip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--baseline", help="Compare stage latencies against a previous --output file")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    tokenizer = build_tokenizer()
+    started = time.perf_counter()
+    model = RecLLM(
+        model_name="random-llama",
+        tokenizer=tokenizer,
+        model=build_model(len(tokenizer), args.hidden_size, args.layers)
+    )
+    model.warmup()
+    load_seconds = time.perf_counter() - started
+
+    youtube_client = FakeYouTubeClient(latency_ms=args.api_latency_ms)
+    results = {
+        "config": vars(args),
+        "load_seconds": load_seconds,
+        "rounds": []
+    }
+    try:
+        for clients in args.clients:
+            with tempfile.TemporaryDirectory() as profile_dir:
+                results["rounds"].append(run_round(model, youtube_client, profile_dir, clients, args.requests))
+    finally:
+        shutdown_executors()
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["youtube_calls"] = youtube_client.calls
+
+    for result in results["rounds"]:
+        print(f"\nclients={result['clients']}  {result['chat_requests_per_second']:.2f} chat req/s  "
+              f"{result['generated_tokens_per_second']:.0f} generated tok/s")
+        print(f"  {'stage':<24} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+        for stage, summary in sorted(result["stages"].items()):
+            print(f"  {stage:<24} {summary['count']:>6} {summary['p50'] * 1000:>9.1f} "
+                  f"{summary['p90'] * 1000:>9.1f} {summary['p99'] * 1000:>9.1f}")
+    print(f"\npeak RSS {results['peak_rss_mb']:.0f} MB, load {load_seconds:.1f}s")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compare RecLLM precision modes on the ranking task.
+
+Loads the model once per precision, ranks the fixture candidates and
+reports load time, ranking latency, peak RSS and agreement with the
+float32 scores:
+
+    python -m recllm.benchmarks.precision --model google/gemma-2b-it --modes float32 bfloat16 int8
+"""
+from typing import Dict, List
+import argparse
+import json
+import multiprocessing
+import resource
+import statistics
+import time
+from recllm.models.rec_llm import RecLLM, PRECISIONS
+from recllm.benchmarks.fixtures import CONVERSATION, RELEVANT_PROFILE, VIDEOS
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def spearman(a: List[float], b: List[float]) -> float:
+    """Spearman rank correlation of two equally long score lists."""
+    def ranks(values):
+        order = sorted(range(len(values)), key=lambda i: values[i])
+        result = [0.0] * len(values)
+        for rank, i in enumerate(order):
+            result[i] = float(rank)
+        return result
+
+    ra, rb = ranks(a), ranks(b)
+    n = len(a)
+    return 1 - 6 * sum((x - y) ** 2 for x, y in zip(ra, rb)) / (n * (n * n - 1))
+
+
+def evaluate(model_name: str, precision: str, repeats: int, top_k: int) -> Dict:
+    started = time.perf_counter()
+    # Caches off so every repeat pays the full ranking cost
+    rec_llm = RecLLM(model_name=model_name, precision=precision, prefix_cache_bytes=0)
+    load_seconds = time.perf_counter() - started
+
+    conversation_context = "\n".join(f"{msg['role']}: {msg['content']}" for msg in CONVERSATION)
+    latencies, ranked = [], []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        ranked = rec_llm.rank_videos(VIDEOS, conversation_context, RELEVANT_PROFILE, top_k=len(VIDEOS))
+        latencies.append(time.perf_counter() - started)
+
+    scores = {video["id"]: video["score"] for video in ranked}
+    return {
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "rank_latency_median": statistics.median(latencies),
+        "rank_latency_min": min(latencies),
+        "peak_rss_mb": peak_rss_mb(),
+        "scores": scores,
+        "top_k": [video["id"] for video in ranked[:top_k]]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="google/gemma-2b-it")
+    parser.add_argument("--modes", nargs="+", default=["float32", "bfloat16", "int8"], choices=PRECISIONS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    # float32 is the reference for agreement metrics
+    modes = ["float32"] + [mode for mode in args.modes if mode != "float32"]
+    # A fresh process per mode keeps peak RSS measurements independent
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for mode in modes:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(evaluate, (args.model, mode, args.repeats, args.top_k)))
+
+    reference = results[0]
+    ids = [video["id"] for video in VIDEOS]
+    for result in results:
+        reference_scores = [reference["scores"][video_id] for video_id in ids]
+        scores = [result["scores"][video_id] for video_id in ids]
+        result["mean_abs_score_diff"] = statistics.mean(abs(a - b) for a, b in zip(scores, reference_scores))
+        result["spearman_vs_float32"] = spearman(scores, reference_scores)
+        result["top_k_overlap"] = len(set(result["top_k"]) & set(reference["top_k"])) / args.top_k
+
+    print(f"{'precision':<10} {'load s':>8} {'rank s':>8} {'peak MB':>9} {'|Δscore|':>9} {'spearman':>9} {'top-k':>6}")
+    for result in results:
+        print(
+            f"{result['precision']:<10} {result['load_seconds']:>8.1f} {result['rank_latency_median']:>8.2f} "
+            f"{result['peak_rss_mb']:>9.0f} {result['mean_abs_score_diff']:>9.3f} "
+            f"{result['spearman_vs_float32']:>9.3f} {result['top_k_overlap']:>6.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+from typing import List, Optional, Tuple
+from collections import OrderedDict
+import threading
+
+
+class ConversationWindow:
+    """Fits conversation history into a token budget, newest turns first.
+
+    Tokenized turns are cached per session, so a new request only tokenizes
+    the turns that were appended since the previous one. When the history
+    does not fit, the oldest turns are dropped and replaced by a short
+    marker; the latest turn is always kept, trimmed from its start if it
+    alone exceeds the budget. fit() returns text, fit_ids() the same window
+    as token ids assembled from the cached turns.
+    """
+
+    def __init__(self, tokenizer, max_sessions: int = 1024):
+        self.tokenizer = tokenizer
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, List[Tuple[str, List[int]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._newline_ids = tokenizer.encode("\n", add_special_tokens=False)
+
+    def fit(
+        self,
+        turns: List[str],
+        budget: Optional[int] = None,
+        session_id: Optional[str] = None
+    ) -> str:
+        """Join turns with newlines, keeping as many recent turns as fit in budget tokens."""
+        if budget is None or not turns:
+            return "\n".join(turns)
+
+        kept, dropped = self._window(turns, budget, session_id)
+        if dropped is None:
+            return self.tokenizer.decode(kept[0][1], skip_special_tokens=True).rstrip("\n")
+
+        texts = [text for text, _ in kept]
+        if dropped:
+            texts.insert(0, self._marker(dropped))
+        return "\n".join(texts)
+
+    def fit_ids(
+        self,
+        turns: List[str],
+        budget: Optional[int] = None,
+        session_id: Optional[str] = None
+    ) -> List[int]:
+        """Token ids of fit(), reusing the session's tokenized turns."""
+        if not turns:
+            return []
+        if budget is None:
+            kept, dropped = self._tokenize(turns, session_id), 0
+        else:
+            kept, dropped = self._window(turns, budget, session_id)
+        if dropped is None:
+            return kept[0][1]
+
+        pieces = [ids for _, ids in kept]
+        if dropped:
+            pieces.insert(0, self.tokenizer.encode(self._marker(dropped), add_special_tokens=False))
+        ids = []
+        for piece in pieces:
+            if ids:
+                ids.extend(self._newline_ids)
+            ids.extend(piece)
+        return ids
+
+    def _window(
+        self,
+        turns: List[str],
+        budget: int,
+        session_id: Optional[str]
+    ) -> Tuple[List[Tuple[str, List[int]]], Optional[int]]:
+        """Return the kept (text, ids) turns and how many were dropped.
+
+        When the latest turn alone is over budget, the single kept entry
+        holds its last budget tokens and the dropped count is None.
+        """
+        tokenized = self._tokenize(turns, session_id)
+        kept, used = [], 0
+        for text, ids in reversed(tokenized):
+            # Each turn is followed by a newline
+            if used + len(ids) + len(self._newline_ids) > budget:
+                break
+            kept.append((text, ids))
+            used += len(ids) + len(self._newline_ids)
+
+        if not kept:
+            # The latest turn alone is over budget: keep its end
+            return [(tokenized[-1][0], tokenized[-1][1][-budget:])], None
+
+        kept.reverse()
+        return kept, len(turns) - len(kept)
+
+    @staticmethod
+    def _marker(dropped: int) -> str:
+        return f"[{dropped} earlier messages omitted]"
+
+    def _tokenize(self, turns: List[str], session_id: Optional[str]) -> List[Tuple[str, List[int]]]:
+        cached: List[Tuple[str, List[int]]] = []
+        if session_id is not None:
+            with self._lock:
+                cached = self._sessions.get(session_id, [])
+
+        # Reuse the cached tokens of the unchanged leading turns
+        reused = 0
+        for (cached_text, _), text in zip(cached, turns):
+            if cached_text != text:
+                break
+            reused += 1
+
+        tokenized = cached[:reused] + [
+            (text, self.tokenizer.encode(text, add_special_tokens=False))
+            for text in turns[reused:]
+        ]
+
+        if session_id is not None:
+            with self._lock:
+                self._sessions[session_id] = tokenized
+                self._sessions.move_to_end(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+        return tokenized
@@ -0,0 +1,126 @@
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+
+@dataclass(frozen=True)
+class DecodingConfig:
+    """Decoding budget of one pipeline stage.
+
+    max_new_tokens caps the output alone rather than prompt plus output, and
+    generation also ends at the first stop string. temperature=None means
+    greedy decoding. Stop strings only count once the output has some
+    non-whitespace text, so a model opening with a newline is not cut off
+    empty. assisted marks long outputs worth drafting with the
+    draft model, when one is configured.
+    """
+    max_new_tokens: int
+    temperature: Optional[float] = None
+    stop_strings: Tuple[str, ...] = ()
+    assisted: bool = False
+
+    def generate_kwargs(self, deterministic: bool = False) -> Dict:
+        kwargs = {"max_new_tokens": self.max_new_tokens}
+        if self.temperature is None or deterministic:
+            kwargs["do_sample"] = False
+        else:
+            kwargs["do_sample"] = True
+            kwargs["temperature"] = self.temperature
+        if self.stop_strings:
+            kwargs["stop_strings"] = self.stop_strings
+        return kwargs
+
+
+STAGE_DECODING = {
+    "conversation": DecodingConfig(max_new_tokens=256, temperature=0.7, assisted=True),
+    "profile_aspects": DecodingConfig(max_new_tokens=160, temperature=0.7, assisted=True),
+    "profile_update": DecodingConfig(max_new_tokens=256, temperature=0.7, assisted=True),
+    "profile_compaction": DecodingConfig(max_new_tokens=256, assisted=True),
+    "search_query": DecodingConfig(max_new_tokens=24, stop_strings=("\n",)),
+    "planning": DecodingConfig(max_new_tokens=160, temperature=0.7, assisted=True),
+    # Explanations are one line following the score
+    "rank_explanation": DecodingConfig(max_new_tokens=48, stop_strings=("\n",)),
+    "rank_generate": DecodingConfig(max_new_tokens=52),
+    "response": DecodingConfig(max_new_tokens=320, temperature=0.7, assisted=True)
+}
+
+
+def strip_stop_strings(text: str, stop_strings: Tuple[str, ...]) -> str:
+    """Cut generated text at the first stop string after its leading whitespace."""
+    start = len(text) - len(text.lstrip())
+    for stop in stop_strings:
+        index = text.find(stop, start)
+        if index != -1:
+            text = text[:index]
+    return text
+
+
+class StopAfterTextCriteria(StoppingCriteria):
+    """End each row at its first stop string that follows non-whitespace output.
+
+    Unlike generate()'s stop_strings, stop strings in the leading whitespace
+    of the output are ignored. prompt_length is the padded prompt width.
+    """
+
+    def __init__(self, tokenizer, stop_strings: Tuple[str, ...], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop_strings = stop_strings
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        done = [strip_stop_strings(text, self.stop_strings) != text for text in texts]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class RankingFormatLogitsProcessor(LogitsProcessor):
+    """Force generations into RANKING_PROMPT's "[score]\\n[explanation]" format.
+
+    The first four tokens are constrained to a score line "0.d" or "1.0"
+    followed by a newline; after that the explanation is free text, ended
+    with EOS as soon as it emits another newline. The prompt length is taken
+    from the first call, so the processor must be fresh per generate() call.
+    """
+
+    def __init__(
+        self,
+        leading_digit_ids: List[int],
+        decimal_digit_ids: List[int],
+        dot_id: int,
+        newline_id: int,
+        eos_token_id: int
+    ):
+        # leading_digit_ids is [id("0"), id("1")]; decimal_digit_ids is ids of "0".."9"
+        self.leading_digit_ids = leading_digit_ids
+        self.decimal_digit_ids = decimal_digit_ids
+        self.dot_id = dot_id
+        self.newline_id = newline_id
+        self.eos_token_id = eos_token_id
+        self.prompt_length = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        step = input_ids.shape[1] - self.prompt_length
+
+        allowed = torch.zeros_like(scores, dtype=torch.bool)
+        if step == 0:
+            allowed[:, self.leading_digit_ids] = True
+        elif step == 1:
+            allowed[:, self.dot_id] = True
+        elif step == 2:
+            # "1." may only be followed by "0"
+            starts_with_one = input_ids[:, self.prompt_length] == self.leading_digit_ids[1]
+            allowed[:, self.decimal_digit_ids] = ~starts_with_one.unsqueeze(1)
+            allowed[starts_with_one, self.decimal_digit_ids[0]] = True
+        elif step == 3:
+            allowed[:, self.newline_id] = True
+        else:
+            ended_line = input_ids[:, -1] == self.newline_id
+            if step == 4 or not ended_line.any():
+                return scores
+            allowed[~ended_line] = True
+            allowed[ended_line, self.eos_token_id] = True
+
+        return scores.masked_fill(~allowed, float("-inf"))
@@ -0,0 +1,63 @@
+from typing import Any, Dict, Optional
+import hashlib
+import json
+import threading
+from recllm.utils.response_cache import ResponseCache
+from recllm.prompts.compiled import Prompt
+
+
+class OutputCache:
+    """Content-addressed cache of deterministic LLM stage outputs.
+
+    Keys hash the stage name, a caller-supplied tag (e.g. the user's profile
+    timestamp, so entries are orphaned when the profile changes), the rendered
+    prompt, the model id and the decoding parameters. Storage is a
+    ResponseCache: an in-memory LRU with an optional SQLite tier.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        max_entries: int = 4096,
+        ttl_seconds: float = 7 * 24 * 3600,
+        disk_path: Optional[str] = None
+    ):
+        self.model_id = model_id
+        self._store = ResponseCache(
+            "llm_outputs",
+            ttl_seconds=ttl_seconds,
+            max_entries=max_entries,
+            disk_path=disk_path
+        )
+        self._lock = threading.Lock()
+        self._stage_counters: Dict[str, Dict[str, int]] = {}
+
+    def key(self, stage: str, prompt: Prompt, tag: Optional[str] = None, **decoding: Any) -> str:
+        """Hash everything that determines a stage's output."""
+        payload = json.dumps(
+            [stage, tag, self.model_id, prompt, sorted(decoding.items())],
+            default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, stage: str, key: str) -> Optional[Any]:
+        """Return the cached output for key, counting the hit or miss under stage."""
+        value, _ = self._store.lookup(key)
+        with self._lock:
+            counters = self._stage_counters.setdefault(stage, {"hits": 0, "misses": 0})
+            counters["hits" if value is not None else "misses"] += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._store.set(key, value)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return per-stage hit rates."""
+        with self._lock:
+            return {
+                stage: {
+                    **counters,
+                    "hit_rate": counters["hits"] / (counters["hits"] + counters["misses"])
+                }
+                for stage, counters in self._stage_counters.items()
+            }
@@ -0,0 +1,102 @@
+from typing import Dict, List
+from collections import OrderedDict
+import threading
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+from recllm.utils.metrics import CACHE_LOOKUPS
+
+# Characters of the description embedded with the title and channel
+VIDEO_DESCRIPTION_CHARS = 500
+
+
+class PreRanker:
+    """First stage of the ranking cascade: cosine similarity of sentence embeddings.
+
+    A small encoder (mean-pooled, L2-normalised token states) embeds the
+    ranking context and each candidate's title, channel and description.
+    Video embeddings are cached by video id, so a candidate seen before
+    costs one row of a matrix-vector product. Only the best `keep`
+    candidates go on to the LLM ranker.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        device: str = "cpu",
+        max_length: int = 256,
+        max_cached: int = 50000,
+        batch_size: int = 32
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.max_length = max_length
+        self.max_cached = max_cached
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to(device)
+        self.model.eval()
+        self._embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def select(self, videos: List[Dict], context: str, keep: int) -> List[int]:
+        """Indices of the `keep` candidates most similar to context, best first."""
+        scores = self.score(videos, context)
+        if keep >= len(videos):
+            return [int(i) for i in np.argsort(-scores)]
+        best = np.argpartition(-scores, keep - 1)[:keep]
+        return [int(i) for i in best[np.argsort(-scores[best])]]
+
+    def score(self, videos: List[Dict], context: str) -> np.ndarray:
+        """Cosine similarity of each video to context."""
+        if not videos:
+            return np.zeros(0, dtype=np.float32)
+        return self.embed_videos(videos) @ self.embed([context])[0]
+
+    def embed_videos(self, videos: List[Dict]) -> np.ndarray:
+        """Embeddings of videos as rows, computing only those not cached yet."""
+        with self._lock:
+            cached = {video["id"]: self._embeddings.get(video["id"]) for video in videos}
+            for video_id, embedding in cached.items():
+                if embedding is not None:
+                    self._embeddings.move_to_end(video_id)
+
+        missing = list({video["id"]: video for video in videos if cached[video["id"]] is None}.values())
+        CACHE_LOOKUPS.inc(len(videos) - len(missing), cache="video_embeddings", result="hit")
+        CACHE_LOOKUPS.inc(len(missing), cache="video_embeddings", result="miss")
+        if missing:
+            embeddings = self.embed([self._video_text(video) for video in missing])
+            with self._lock:
+                for video, embedding in zip(missing, embeddings):
+                    cached[video["id"]] = embedding
+                    self._embeddings[video["id"]] = embedding
+                while len(self._embeddings) > self.max_cached:
+                    self._embeddings.popitem(last=False)
+
+        return np.stack([cached[video["id"]] for video in videos])
+
+    @torch.no_grad()
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """L2-normalised mean-pooled embeddings of texts as rows."""
+        batches = []
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="pt"
+            ).to(self.device)
+            states = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(states.dtype)
+            pooled = (states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            batches.append(torch.nn.functional.normalize(pooled, dim=-1).float().cpu().numpy())
+        return np.concatenate(batches)
+
+    @staticmethod
+    def _video_text(video: Dict) -> str:
+        return "\n".join([
+            video.get("title", ""),
+            video.get("channel_title", ""),
+            (video.get("description") or "")[:VIDEO_DESCRIPTION_CHARS]
+        ])
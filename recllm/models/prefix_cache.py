@@ -0,0 +1,114 @@
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+import copy
+import threading
+
+
+class PrefixCache:
+    """LRU store of past_key_values for prompt prefixes, keyed by session and token ids.
+
+    Lookups return the longest cached prefix shared with a new prompt, cropped
+    to the shared length, so a stage only has to prefill its new suffix.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 1024 ** 3,
+        max_entries_per_session: int = 8,
+        min_prefix_tokens: int = 16
+    ):
+        self.max_bytes = max_bytes
+        self.max_entries_per_session = max_entries_per_session
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries: "OrderedDict[Tuple[str, Tuple[int, ...]], Tuple[object, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, session_id: str, input_ids: List[int]) -> Tuple[int, Optional[object]]:
+        """Return (prefix length, private cache copy) for the longest shared prefix."""
+        with self._lock:
+            best_key, best_length = None, 0
+            for key in self._entries:
+                if key[0] != session_id:
+                    continue
+                length = _common_prefix_length(key[1], input_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            if best_key is None or best_length < self.min_prefix_tokens:
+                self.misses += 1
+                return 0, None
+
+            self._entries.move_to_end(best_key)
+            cache = copy.deepcopy(self._entries[best_key][0])
+            self.hits += 1
+            self.reused_tokens += best_length
+
+        if cache.get_seq_length() > best_length:
+            cache.crop(best_length)
+        return best_length, cache
+
+    def store(self, session_id: str, input_ids: List[int], past_key_values) -> None:
+        """Keep a copy of the cache covering exactly input_ids."""
+        if len(input_ids) < self.min_prefix_tokens:
+            return
+
+        key = (session_id, tuple(input_ids))
+        cache = copy.deepcopy(past_key_values)
+        size = _cache_nbytes(cache)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+
+            # An entry that is a strict prefix of the new one is redundant
+            for other in [k for k in self._entries if k[0] == session_id]:
+                if len(other[1]) < len(input_ids) and key[1][:len(other[1])] == other[1]:
+                    self._total_bytes -= self._entries.pop(other)[1]
+
+            self._entries[key] = (cache, size)
+            self._total_bytes += size
+
+            session_keys = [k for k in self._entries if k[0] == session_id]
+            for stale in session_keys[:-self.max_entries_per_session]:
+                self._total_bytes -= self._entries.pop(stale)[1]
+
+            while self._total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+
+    def stats(self) -> Dict[str, int]:
+        """Return cache occupancy and hit counters."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens
+            }
+
+
+def _common_prefix_length(a, b) -> int:
+    """Length of the shared leading run of two token id sequences."""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _cache_nbytes(past_key_values) -> int:
+    """Approximate memory held by a cache's key/value tensors."""
+    total = 0
+    for layer in past_key_values:
+        for tensor in layer:
+            if tensor is not None:
+                total += tensor.numel() * tensor.element_size()
+    return total
@@ -1,181 +1,979 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional, Tuple
+from concurrent.futures import Executor
+import os
+import re
+import threading
+import time
 import torch
 import torch.nn as nn
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    TextIteratorStreamer
+)
 from recllm.prompts.templates import (
     MAIN_CONVERSATION_PROMPT,
     SEARCH_QUERY_PROMPT,
+    PLANNING_PROMPT,
     RANKING_PROMPT,
     RESPONSE_GENERATION_PROMPT
 )
+from recllm.prompts.compiled import CompiledTemplate, FieldEncoder, Prompt, Slot
+from recllm.models.prefix_cache import PrefixCache, _common_prefix_length
+from recllm.models.context_window import ConversationWindow
+from recllm.models.pre_ranker import PreRanker
+from recllm.models.decoding import (
+    STAGE_DECODING,
+    RankingFormatLogitsProcessor,
+    StopAfterTextCriteria,
+    strip_stop_strings
+)
+from recllm.utils.metrics import ASSISTED_DECODING, CACHE_LOOKUPS, TOKENS, current_stage, timed
 import logging
 
+# Ranking scores are read from the next-token distributions of a single
+# forward pass over "<prompt>\n0.": the position after the newline gives
+# P(score starts with "1") vs P("0"), the position after "0." gives the
+# tenths digit. The expected value of both lands the score in [0, 1].
+SCORE_SEPARATOR = "\n"
+SCORE_LEADING_DIGITS = ["0", "1"]
+SCORE_DECIMAL_PREFIX = "0."
+SCORE_DECIMAL_DIGITS = [str(digit) for digit in range(10)]
+SCORING_MODES = ("logits", "generate")
+
+PRECISIONS = ("float32", "bfloat16", "int8", "int4")
+
+# Token budget for the conversation history in each stage's prompt; older
+# turns beyond it are dropped first so the latest messages always survive
+CONVERSATION_TOKEN_BUDGETS = {
+    "conversation": 512,
+    "profile_aspects": 512,
+    "search_query": 384,
+    "planning": 384,
+    "ranking": 384,
+    "response": 512
+}
+
+# Ranking prompts keep only the start of long video descriptions
+VIDEO_DESCRIPTION_TOKENS = 256
+
+PLANNING_MAX_QUERIES = 3
+_QUERIES_HEADER = re.compile(r"^[\s*#]*(?:search\s+)?queries[\s*]*:[ \t*]*", re.IGNORECASE | re.MULTILINE)
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+
+def parse_plan(text: str, max_queries: int = PLANNING_MAX_QUERIES) -> Tuple[str, List[str]]:
+    """Split a PLANNING_PROMPT completion into (relevant preferences, search queries).
+
+    Tolerates a missing or restyled "Queries:" header, list markers,
+    numbering and quotes; queries are de-duplicated case-insensitively.
+    Either part may come back empty when the completion lacks it.
+    """
+    header = _QUERIES_HEADER.search(text)
+    if header:
+        aspects, rest = text[:header.start()], text[header.end():]
+    else:
+        # Without a header, the queries are the list items after the description
+        lines = text.strip().split("\n")
+        first_item = next((i for i, line in enumerate(lines) if _LIST_MARKER.match(line)), len(lines))
+        aspects, rest = "\n".join(lines[:first_item]), "\n".join(lines[first_item:])
+
+    queries, seen = [], set()
+    for line in rest.split("\n"):
+        query = _LIST_MARKER.sub("", line).strip().strip("\"'`[]").strip()
+        if not query:
+            # A blank line after the list ends it, before any closing remarks
+            if queries:
+                break
+            continue
+        if header is None and not _LIST_MARKER.match(line):
+            break
+        if query.lower() not in seen:
+            seen.add(query.lower())
+            queries.append(query)
+        if len(queries) == max_queries:
+            break
+
+    aspects = re.sub(r"^\s*relevant preferences\s*:", "", aspects.strip(), flags=re.IGNORECASE)
+    return aspects.strip(), queries
+
+
+def _latest_user_message(conversation_history: List[Dict[str, str]]) -> str:
+    """Search query fallback for when the model generates an empty one."""
+    return next(
+        (msg["content"].strip() for msg in reversed(conversation_history) if msg["role"] == "user"),
+        ""
+    )
+
 class RecLLM(nn.Module):
     def __init__(
         self,
         model_name: str = "google/gemma-2-2b-it",
-        device: str = "cpu"
+        device: str = "cpu",
+        prefix_cache_bytes: Optional[int] = None,
+        deterministic: Optional[bool] = None,
+        precision: Optional[str] = None,
+        tokenizer=None,
+        model: Optional[nn.Module] = None,
+        draft_model_name: Optional[str] = None,
+        pre_ranker_name: Optional[str] = None,
+        pre_rank_k: Optional[int] = None,
+        profile_token_budget: Optional[int] = None
     ):
         super().__init__()
+        self.model_name = model_name
         self.device = device
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            device_map=None,
-            torch_dtype=torch.float32,
-            low_cpu_mem_usage=True
-        ).to(device)
+        self.precision = precision or os.getenv("RECLLM_PRECISION", "float32")
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {self.precision!r}, expected one of {PRECISIONS}")
+        if deterministic is None:
+            deterministic = os.getenv("RECLLM_DETERMINISTIC", "0") == "1"
+        # Greedy decoding everywhere except the user-facing response, which
+        # makes the intermediate stages reproducible and therefore cacheable
+        self.deterministic = deterministic
+        if prefix_cache_bytes is None:
+            prefix_cache_bytes = int(os.getenv("RECLLM_PREFIX_CACHE_MB", "1024")) * 1024 ** 2
+        # Shared prompt prefixes are reused per session; 0 disables the cache
+        self.prefix_cache = PrefixCache(max_bytes=prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        # A prebuilt tokenizer and model (e.g. a tiny random one for benchmarks)
+        # are used as given instead of being loaded from model_name
+        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained(model_name)
+        self.conversation_window = ConversationWindow(self.tokenizer)
+        # Templates are tokenized once; per call only their fields are
+        self.field_encoder = FieldEncoder(self.tokenizer)
+        self.templates = {
+            "conversation": CompiledTemplate(
+                MAIN_CONVERSATION_PROMPT, self.field_encoder, [Slot("user_message", cached=False)]
+            ),
+            "search_query": CompiledTemplate(SEARCH_QUERY_PROMPT, self.field_encoder),
+            "planning": CompiledTemplate(PLANNING_PROMPT, self.field_encoder),
+            "ranking": CompiledTemplate(
+                RANKING_PROMPT, self.field_encoder, [Slot("video_description", max_tokens=VIDEO_DESCRIPTION_TOKENS)]
+            ),
+            "response": CompiledTemplate(RESPONSE_GENERATION_PROMPT, self.field_encoder)
+        }
+        self.model = model if model is not None else self._load_model(model_name)
+        self.model.eval()
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Optional small model sharing the tokenizer: it drafts tokens that the
+        # main model verifies several at a time in the long, assisted stages
+        self.draft_model_name = draft_model_name or os.getenv("RECLLM_DRAFT_MODEL") or None
+        self.draft_model = None
+        self._forward_counts = {"target": 0, "draft": 0}
+        self._assisted_counters = {
+            "generations": 0,
+            "target_forwards": 0,
+            "draft_tokens": 0,
+            "accepted_tokens": 0,
+            "generated_tokens": 0
+        }
+        if self.draft_model_name:
+            self.draft_model = self._load_draft_model(self.draft_model_name)
+        # Profile descriptions longer than this are re-summarised (0 disables);
+        # below the profile_update output cap, so merges are not cut mid-sentence
+        if profile_token_budget is None:
+            profile_token_budget = int(os.getenv("RECLLM_PROFILE_TOKEN_BUDGET", "192"))
+        self.profile_token_budget = profile_token_budget
+        # Optional small sentence encoder that shortlists the candidates the
+        # LLM ranks; pre_rank_k of them are kept (0 ranks every candidate)
+        self.pre_ranker_name = pre_ranker_name or os.getenv("RECLLM_PRE_RANKER") or None
+        self.pre_ranker = PreRanker(self.pre_ranker_name, device=device) if self.pre_ranker_name else None
+        if pre_rank_k is None:
+            pre_rank_k = int(os.getenv("RECLLM_PRE_RANK_K", "8"))
+        self.pre_rank_k = pre_rank_k
+        # Serialises model calls between request threads and the batch scheduler
+        self._model_lock = threading.RLock()
+        # Optional InferenceScheduler that batches _generate calls across requests
+        self.scheduler = None
+        # Optional OutputCache for greedy stage outputs
+        self.output_cache = None
+        self._separator_ids = self._encode_fragment(SCORE_SEPARATOR)
+        self._decimal_prefix_ids = self._encode_fragment(SCORE_DECIMAL_PREFIX)
+        self._leading_digit_ids = [
+            self._encode_fragment(digit)[-1] for digit in SCORE_LEADING_DIGITS
+        ]
+        self._decimal_digit_ids = [
+            self._encode_fragment(digit)[-1] for digit in SCORE_DECIMAL_DIGITS
+        ]
+        self._dot_id = self._encode_fragment(SCORE_DECIMAL_PREFIX)[-1]
         
+    def warmup(self):
+        """Run a tiny generation and scoring pass so first-call allocation costs are paid up front."""
+        started = time.perf_counter()
+        self.generate_batch(["Hello"], max_new_tokens=4, do_sample=False)
+        self._score_prompts(["Hello", "Hello there"])
+        if self.draft_model is not None:
+            self._check_assisted()
+        logging.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+
     def generate_response(
         self,
         conversation_history: List[Dict[str, str]],
         user_profile: Optional[Dict] = None,
-        max_length: int = 1024
+        max_new_tokens: Optional[int] = None,
+        session_id: Optional[str] = None,
+        stage: str = "conversation",
+        cache_tag: Optional[str] = None,
+        raise_errors: bool = False
     ) -> str:
-        """Generate a response based on conversation history and user profile."""
+        """Generate a response based on conversation history and user profile.
+
+        Decoding follows the stage's entry in STAGE_DECODING; max_new_tokens
+        overrides its output budget. Errors are returned as an apology to the
+        user unless raise_errors is set.
+        """
         try:
-            conv_str = "\n".join([
-                f"{msg['role']}: {msg['content']}"
-                for msg in conversation_history[:-1]  # Exclude the last message
-            ])
-            
-            user_message = conversation_history[-1]["content"] if conversation_history else ""
-            
-            prompt = MAIN_CONVERSATION_PROMPT.format(
-                user_profile=str(user_profile or {}),
-                conversation_history=conv_str,
-                user_message=user_message
-            )
+            with timed(stage):
+                conv_ids = self._conversation_ids(
+                    conversation_history[:-1],  # Exclude the last message
+                    stage="conversation",
+                    session_id=session_id
+                )
             
-            inputs = self.tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=max_length
-            ).to(self.device)
+                user_message = conversation_history[-1]["content"] if conversation_history else ""
             
-            outputs = self.model.generate(
-                **inputs,
-                max_length=max_length,
-                num_return_sequences=1,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
+                prompt = self.templates["conversation"].render(
+                    user_profile=str(user_profile or {}),
+                    conversation_history=conv_ids,
+                    user_message=user_message
+                )
             
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            return self._extract_response(response)
+                response = self._generate(
+                    prompt,
+                    session_id=session_id,
+                    stage=stage,
+                    cache_tag=cache_tag,
+                    **self._decoding(stage, max_new_tokens)
+                )
+                return self._extract_response(response)
             
         except Exception as e:
             logging.error(f"Error in generate_response: {str(e)}", exc_info=True)
+            if raise_errors:
+                raise
             return f"I apologize, but I encountered an error: {str(e)}"
     
+    @timed("search_query")
     def generate_search_query(
         self,
         conversation_history: List[Dict[str, str]],
-        user_profile: Optional[Dict] = None
+        user_profile: Optional[Dict] = None,
+        session_id: Optional[str] = None,
+        cache_tag: Optional[str] = None
     ) -> str:
         """Generate a search query for YouTube based on conversation context."""
-        conv_str = "\n".join([
-            f"{msg['role']}: {msg['content']}"
-            for msg in conversation_history
-        ])
+        conv_ids = self._conversation_ids(
+            conversation_history,
+            stage="search_query",
+            session_id=session_id
+        )
         
-        prompt = SEARCH_QUERY_PROMPT.format(
+        prompt = self.templates["search_query"].render(
             user_profile=str(user_profile or {}),
-            conversation_history=conv_str
+            conversation_history=conv_ids
         )
         
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        outputs = self.model.generate(
-            **inputs,
-            max_length=256,
-            num_return_sequences=1,
-            temperature=0.2
+        query = self._generate(
+            prompt,
+            session_id=session_id,
+            stage="search_query",
+            cache_tag=cache_tag,
+            **self._decoding("search_query")
         )
-        
-        query = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return query.strip()
+        return query.strip() or _latest_user_message(conversation_history)
+
+    @timed("planning")
+    def plan(
+        self,
+        conversation_history: List[Dict[str, str]],
+        user_profile: Optional[str] = None,
+        session_id: Optional[str] = None,
+        cache_tag: Optional[str] = None,
+        max_queries: int = PLANNING_MAX_QUERIES
+    ) -> Tuple[str, List[str]]:
+        """Extract the relevant profile aspects and search queries in a single generation.
+
+        Stands in for get_relevant_profile_aspects followed by
+        generate_search_query, taking the full profile description. Returns
+        (aspects, queries); queries is empty if none could be parsed.
+        """
+        prompt = self.templates["planning"].render(
+            user_profile=user_profile or "",
+            conversation_history=self._conversation_ids(
+                conversation_history,
+                stage="planning",
+                session_id=session_id
+            )
+        )
+
+        completion = self._generate(
+            prompt,
+            session_id=session_id,
+            stage="planning",
+            cache_tag=cache_tag,
+            **self._decoding("planning")
+        )
+        return parse_plan(completion, max_queries)
+
+    @timed("search_query")
+    def generate_search_queries(
+        self,
+        conversation_histories: List[List[Dict[str, str]]],
+        user_profiles: List[Optional[str]],
+        batch_size: int = 16
+    ) -> List[str]:
+        """Generate search queries for many conversations as batches, e.g. in offline jobs."""
+        prompts = [
+            self.templates["search_query"].render(
+                user_profile=str(user_profile or {}),
+                conversation_history=self._conversation_ids(conversation_history, stage="search_query")
+            )
+            for conversation_history, user_profile in zip(conversation_histories, user_profiles)
+        ]
+        queries = self._cached_batch(
+            "search_query",
+            prompts,
+            None,
+            lambda batch: self.generate_batch(batch, **self._decoding("search_query")),
+            batch_size
+        )
+        return [
+            query.strip() or _latest_user_message(conversation_history)
+            for query, conversation_history in zip(queries, conversation_histories)
+        ]
     
+    @timed("ranking")
     def rank_videos(
         self,
         video_candidates: List[Dict],
         conversation_context: str,
-        user_profile: Optional[Dict] = None
+        user_profile: Optional[Dict] = None,
+        top_k: Optional[int] = None,
+        batch_size: int = 16,
+        session_id: Optional[str] = None,
+        cache_tag: Optional[str] = None,
+        scoring: str = "logits",
+        pre_rank_k: Optional[int] = None
     ) -> List[Dict]:
-        """Rank video candidates based on conversation context and user profile."""
-        ranked_videos = []
-        for video in video_candidates:
-            prompt = RANKING_PROMPT.format(
+        """Rank video candidates based on conversation context and user profile.
+
+        With a pre-ranker, only the pre_rank_k candidates (default
+        self.pre_rank_k, 0 for all) most similar to the context are ranked.
+
+        With scoring="logits", candidates are scored in batched forward passes
+        from the next-token distribution over score digits, and one-line
+        explanations are generated only for the top_k videos that are
+        returned. With scoring="generate", every candidate's score and
+        explanation are decoded together, constrained to RANKING_PROMPT's
+        "[score]\\n[explanation]" format so the score always parses.
+        """
+        if scoring not in SCORING_MODES:
+            raise ValueError(f"Unknown scoring {scoring!r}, expected one of {SCORING_MODES}")
+        if not video_candidates:
+            return []
+
+        pre_rank_k = self.pre_rank_k if pre_rank_k is None else pre_rank_k
+        if self.pre_ranker is not None and 0 < pre_rank_k < len(video_candidates):
+            video_candidates = self._pre_rank(video_candidates, conversation_context, user_profile, pre_rank_k)
+
+        prompts = [
+            self.templates["ranking"].render(
                 video_title=video.get("title", ""),
                 video_description=video.get("description", ""),
                 channel_title=video.get("channel_title", ""),
                 user_profile=str(user_profile or {}),
                 conversation_context=conversation_context
             )
-            
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-            outputs = self.model.generate(
-                **inputs,
-                max_length=512,
-                num_return_sequences=1,
-                temperature=0.3
-            )
-            
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
-            try:
-                lines = response.strip().split("\n")
-                score = float(lines[0])
-                explanation = "\n".join(lines[1:])
-            except Exception as e:
-                score = 0.0
-                explanation = f"Failed to generate explanation: {e}"
-            
-            ranked_videos.append({
-                **video,
-                "score": score,
+            for video in video_candidates
+        ]
+
+        if scoring == "generate":
+            return self._rank_by_generation(video_candidates, prompts, top_k, batch_size, cache_tag)
+
+        scores = self._cached_batch(
+            "rank_score",
+            prompts,
+            cache_tag,
+            lambda batch: self._score_prompts(batch, session_id),
+            batch_size
+        )
+
+        order = sorted(range(len(video_candidates)), key=lambda i: scores[i], reverse=True)
+        if top_k is not None:
+            order = order[:top_k]
+
+        explanations = self._cached_batch(
+            "rank_explanation",
+            [prompts[i] + self._encode_fragment(f"{SCORE_SEPARATOR}{scores[i]:.1f}\n") for i in order],
+            cache_tag,
+            self._generate_explanations,
+            batch_size
+        )
+
+        return [
+            {
+                **video_candidates[i],
+                "score": scores[i],
                 "explanation": explanation
-            })
-        
-        ranked_videos.sort(key=lambda x: x["score"], reverse=True)
-        return ranked_videos
-    
+            }
+            for i, explanation in zip(order, explanations)
+        ]
+
+    @timed("pre_rank")
+    def _pre_rank(
+        self,
+        video_candidates: List[Dict],
+        conversation_context: str,
+        user_profile: Optional[Dict],
+        keep: int
+    ) -> List[Dict]:
+        context = f"{conversation_context}\n{user_profile or ''}"
+        return [video_candidates[i] for i in self.pre_ranker.select(video_candidates, context, keep)]
+
+    @torch.no_grad()
+    def _score_prompts(self, prompts: List[Prompt], session_id: Optional[str] = None) -> List[float]:
+        """Score a batch of ranking prompts in a single forward pass.
+
+        The prefix shared by every prompt (conversation and profile) is
+        prefilled once, possibly from the prefix cache, and broadcast across
+        the batch so only the per-video suffixes are processed together.
+        """
+        suffix_ids = self._separator_ids + self._decimal_prefix_ids
+        sequences = [ids + suffix_ids for ids in self._token_ids(prompts)]
+        shared = min(_common_prefix_length(sequences[0], ids) for ids in sequences)
+        shared = min(shared, min(len(ids) for ids in sequences) - len(suffix_ids))
+
+        # Right padding keeps every prompt at the same absolute positions
+        inputs = self._pad_batch([ids[shared:] for ids in sequences], padding_side="right")
+        lengths = inputs["attention_mask"].sum(dim=1)
+
+        with self._model_lock:
+            past_key_values = None
+            if shared > 0:
+                past_key_values = self._prefill(sequences[0][:shared], session_id)
+                past_key_values.batch_repeat_interleave(len(sequences))
+                inputs["attention_mask"] = torch.cat([
+                    torch.ones((len(sequences), shared), dtype=torch.long, device=self.device),
+                    inputs["attention_mask"]
+                ], dim=1)
+            # Only two positions per row are read, so the LM head is applied to
+            # just those rather than to the whole suffix's full-vocabulary logits
+            hidden = self.model.get_decoder()(**inputs, past_key_values=past_key_values).last_hidden_state
+            rows = torch.arange(len(sequences), device=hidden.device)
+            leading_index = lengths - len(self._decimal_prefix_ids) - 1
+            decimal_index = lengths - 1
+            leading_logits = self._output_logits(hidden[rows, leading_index])
+            decimal_logits = self._output_logits(hidden[rows, decimal_index])
+        self._count_tokens(sum(len(ids) for ids in sequences), 0)
+
+        leading = torch.softmax(leading_logits[:, self._leading_digit_ids], dim=-1)
+        decimal = torch.softmax(decimal_logits[:, self._decimal_digit_ids], dim=-1)
+        tenths = torch.arange(len(SCORE_DECIMAL_DIGITS), dtype=decimal.dtype, device=decimal.device)
+        expected_decimal = (decimal * tenths).sum(dim=-1) / 10
+
+        scores = leading[:, 1] + leading[:, 0] * expected_decimal
+        return scores.tolist()
+
+    def _output_logits(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Float32 logits for final hidden states, as the causal LM head computes them."""
+        logits = self.model.get_output_embeddings()(hidden_states).float()
+        softcap = getattr(self.model.config, "final_logit_softcapping", None)
+        if softcap:
+            logits = torch.tanh(logits / softcap) * softcap
+        return logits
+
+    def _generate_explanations(self, prompts: List[Prompt]) -> List[str]:
+        """Generate ranking explanations for a batch of already-scored prompts."""
+        if not prompts:
+            return []
+
+        explanations = self.generate_batch(prompts, **self._decoding("rank_explanation"))
+        return [explanation.strip() for explanation in explanations]
+
+    def _rank_by_generation(
+        self,
+        video_candidates: List[Dict],
+        prompts: List[List[int]],
+        top_k: Optional[int],
+        batch_size: int,
+        cache_tag: Optional[str]
+    ) -> List[Dict]:
+        """Rank by decoding each candidate's score line and explanation."""
+        results = self._cached_batch(
+            "rank_generate",
+            [prompt + self._separator_ids for prompt in prompts],
+            cache_tag,
+            self._generate_scored,
+            batch_size
+        )
+
+        order = sorted(range(len(video_candidates)), key=lambda i: results[i][0], reverse=True)
+        if top_k is not None:
+            order = order[:top_k]
+
+        return [
+            {
+                **video_candidates[i],
+                "score": results[i][0],
+                "explanation": results[i][1]
+            }
+            for i in order
+        ]
+
+    def _generate_scored(self, prompts: List[Prompt]) -> List[List]:
+        """Generate "[score]\\n[explanation]" completions and parse them as [score, explanation]."""
+        processor = RankingFormatLogitsProcessor(
+            leading_digit_ids=self._leading_digit_ids,
+            decimal_digit_ids=self._decimal_digit_ids,
+            dot_id=self._dot_id,
+            newline_id=self._separator_ids[-1],
+            eos_token_id=self.tokenizer.eos_token_id
+        )
+        completions = self.generate_batch(
+            prompts,
+            logits_processor=LogitsProcessorList([processor]),
+            **self._decoding("rank_generate")
+        )
+
+        results = []
+        for completion in completions:
+            score_line, _, explanation = completion.partition("\n")
+            results.append([float(score_line), explanation.strip()])
+        return results
+
+    @timed("response")
     def generate_recommendation_response(
         self,
         conversation_history: List[Dict[str, str]],
         recommendations: List[Dict],
-        user_profile: Optional[Dict] = None
+        user_profile: Optional[Dict] = None,
+        session_id: Optional[str] = None
     ) -> str:
         """Generate a natural language response with recommendations."""
-        conv_str = "\n".join([
-            f"{msg['role']}: {msg['content']}"
-            for msg in conversation_history
-        ])
+        prompt = self._recommendation_prompt(conversation_history, recommendations, user_profile, session_id)
+        response = self._generate(
+            prompt,
+            session_id=session_id,
+            **self._decoding("response")
+        )
+        return response.strip()
+
+    def stream_recommendation_response(
+        self,
+        conversation_history: List[Dict[str, str]],
+        recommendations: List[Dict],
+        user_profile: Optional[Dict] = None,
+        session_id: Optional[str] = None,
+        executor: Optional[Executor] = None
+    ) -> Iterator[str]:
+        """Yield the recommendation response text incrementally as it is generated.
+
+        Generation runs on the given executor, or a dedicated thread if none.
+        """
+        prompt = self._recommendation_prompt(conversation_history, recommendations, user_profile, session_id)
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True
+        )
+
+        def run():
+            try:
+                with timed("response"):
+                    self._generate(
+                        prompt,
+                        session_id=session_id,
+                        streamer=streamer,
+                        **self._decoding("response")
+                    )
+            except Exception as e:
+                logging.error(f"Error in stream_recommendation_response: {str(e)}", exc_info=True)
+                # Unblock the consumer; generate() never reached its own end()
+                streamer.end()
+
+        if executor is not None:
+            done = executor.submit(run).result
+        else:
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            done = thread.join
+
+        for text in streamer:
+            if text:
+                yield text
+        done()
+
+    def _recommendation_prompt(
+        self,
+        conversation_history: List[Dict[str, str]],
+        recommendations: List[Dict],
+        user_profile: Optional[Dict] = None,
+        session_id: Optional[str] = None
+    ) -> List[int]:
+        """Assemble the response generation prompt for the top recommendations."""
+        conv_ids = self._conversation_ids(
+            conversation_history,
+            stage="response",
+            session_id=session_id
+        )
         
         rec_str = "\n".join([
             f"Title: {video['title']}\nExplanation: {video['explanation']}"
             for video in recommendations[:5]  # Top 5 recommendations
         ])
         
-        prompt = RESPONSE_GENERATION_PROMPT.format(
+        return self.templates["response"].render(
             user_profile=str(user_profile or {}),
-            conversation_history=conv_str,
+            conversation_history=conv_ids,
             recommendations=rec_str
         )
-        
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        outputs = self.model.generate(
-            **inputs,
-            max_length=1024,
-            num_return_sequences=1,
-            temperature=0.7
-        )
-        
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return response.strip()
     
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        prompts: List[Prompt],
+        stages: Optional[List[str]] = None,
+        **generate_kwargs
+    ) -> List[str]:
+        """Generate completions for several prompts as one left-padded batch.
+
+        Token counts of each prompt go to its entry in stages, by default the
+        stage being timed on this thread.
+        """
+        sequences = self._token_ids(prompts)
+        inputs = self._pad_batch(sequences, padding_side="left")
+
+        with self._model_lock:
+            outputs = self.model.generate(
+                **inputs,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self._stopping(generate_kwargs, inputs["input_ids"].shape[1])
+            )
+
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        generated = (new_tokens != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        for row, ids in enumerate(sequences):
+            self._count_tokens(len(ids), generated[row], stages[row] if stages else None)
+        return [
+            strip_stop_strings(text, generate_kwargs.get("stop_strings", ()))
+            for text in self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        ]
+
+    def format_conversation(
+        self,
+        conversation_history: List[Dict[str, str]],
+        stage: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> str:
+        """Render messages as "role: content" lines within the stage's token budget."""
+        return self.conversation_window.fit(
+            [f"{msg['role']}: {msg['content']}" for msg in conversation_history],
+            budget=CONVERSATION_TOKEN_BUDGETS.get(stage),
+            session_id=session_id
+        )
+
+    def _conversation_ids(
+        self,
+        conversation_history: List[Dict[str, str]],
+        stage: Optional[str] = None,
+        session_id: Optional[str] = None
+    ) -> List[int]:
+        """Token ids of format_conversation(), from the session's cached turn encodings."""
+        return self.conversation_window.fit_ids(
+            [f"{msg['role']}: {msg['content']}" for msg in conversation_history],
+            budget=CONVERSATION_TOKEN_BUDGETS.get(stage),
+            session_id=session_id
+        )
+
     def _extract_response(self, generated_text: str) -> str:
         """Extract the relevant response from the generated text."""
         response = generated_text.split("Assistant: ")[-1].strip()
-        return response
\ No newline at end of file
+        return response
+
+    @torch.no_grad()
+    def _generate(
+        self,
+        prompt: Prompt,
+        session_id: Optional[str] = None,
+        stage: Optional[str] = None,
+        cache_tag: Optional[str] = None,
+        **generate_kwargs
+    ) -> str:
+        """Generate a completion for a single prompt and return only the new text.
+
+        With a session_id, the longest previously seen prefix of the prompt is
+        restored from the prefix cache so only the new suffix is prefilled.
+        Greedy generations of a named stage are served from the output cache.
+        """
+        cache_key = None
+        if (
+            self.output_cache is not None
+            and stage is not None
+            and not generate_kwargs.get("do_sample", False)
+            and "streamer" not in generate_kwargs
+        ):
+            cache_key = self.output_cache.key(
+                stage, prompt, cache_tag, **generate_kwargs
+            )
+            cached = self.output_cache.get(stage, cache_key)
+            if cached is not None:
+                return cached
+
+        text = self._generate_uncached(prompt, session_id, **generate_kwargs)
+        if cache_key is not None:
+            self.output_cache.set(cache_key, text)
+        return text
+
+    def _generate_uncached(
+        self,
+        prompt: Prompt,
+        session_id: Optional[str],
+        assisted: bool = False,
+        **generate_kwargs
+    ) -> str:
+        if assisted:
+            # Assisted generation decodes one sequence at a time, so it is never batched
+            generate_kwargs["assistant_model"] = self.draft_model
+        elif self.scheduler is not None and "streamer" not in generate_kwargs:
+            # Batched with other requests' jobs; batch rows cannot share a prefix cache
+            return self.scheduler.generate(prompt, **generate_kwargs)
+
+        input_ids = self._token_ids([prompt])[0]
+
+        with self._model_lock:
+            past_key_values = None
+            # Assisted generate() crops and re-extends the target's cache as drafts
+            # are rejected, which a prefilled cache does not survive intact
+            if not assisted and self.prefix_cache is not None and session_id is not None and len(input_ids) > 1:
+                # generate() must still process at least the final prompt token
+                past_key_values = self._prefill(input_ids[:-1], session_id)
+
+            inputs = torch.tensor([input_ids], dtype=torch.long, device=self.device)
+            forwards_before = dict(self._forward_counts)
+            outputs = self.model.generate(
+                input_ids=inputs,
+                attention_mask=torch.ones_like(inputs),
+                past_key_values=past_key_values,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self._stopping(generate_kwargs, len(input_ids))
+            )
+            if assisted:
+                self._record_assisted(forwards_before, outputs.shape[1] - len(input_ids))
+
+        self._count_tokens(len(input_ids), outputs.shape[1] - len(input_ids))
+        return strip_stop_strings(
+            self.tokenizer.decode(outputs[0, len(input_ids):], skip_special_tokens=True),
+            generate_kwargs.get("stop_strings", ())
+        )
+
+    def _load_model(self, model_name: str) -> nn.Module:
+        """Load the model weights in the configured precision.
+
+        bfloat16 halves memory; int8 applies dynamic quantization to every
+        nn.Linear; int4 uses weight-only quantization from the optional
+        torchao package.
+        """
+        # int4 kernels take bfloat16 activations; int8 dynamic quantization starts from float32
+        dtype = torch.bfloat16 if self.precision in ("bfloat16", "int4") else torch.float32
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            device_map=None,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            # safetensors checkpoints are memory-mapped instead of read into RAM
+            use_safetensors=True
+        ).to(self.device)
+
+        if self.precision == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        elif self.precision == "int4":
+            try:
+                from torchao.quantization import quantize_, int4_weight_only
+                from torchao.dtypes import Int4CPULayout
+            except ImportError as e:
+                raise ImportError("int4 precision requires torchao: pip install torchao") from e
+            quantize_(model, int4_weight_only(layout=Int4CPULayout()))
+
+        return model
+
+    def _cached_batch(
+        self,
+        stage: str,
+        prompts: List[Prompt],
+        cache_tag: Optional[str],
+        compute,
+        batch_size: int
+    ) -> List:
+        """Map compute over prompts in batches, skipping prompts with a cached output."""
+        results: List = [None] * len(prompts)
+        keys: List[Optional[str]] = [None] * len(prompts)
+        if self.output_cache is not None:
+            for i, prompt in enumerate(prompts):
+                keys[i] = self.output_cache.key(stage, prompt, cache_tag)
+                results[i] = self.output_cache.get(stage, keys[i])
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        for start in range(0, len(missing), batch_size):
+            chunk = missing[start:start + batch_size]
+            with timed(stage):
+                computed = compute([prompts[i] for i in chunk])
+            for i, result in zip(chunk, computed):
+                results[i] = result
+                if keys[i] is not None:
+                    self.output_cache.set(keys[i], result)
+
+        return results
+
+    def _decoding(self, stage: str, max_new_tokens: Optional[int] = None) -> Dict:
+        """generate() parameters for a stage, greedy in deterministic mode."""
+        config = STAGE_DECODING[stage]
+        kwargs = config.generate_kwargs(self.deterministic)
+        if max_new_tokens is not None:
+            kwargs["max_new_tokens"] = max_new_tokens
+        if config.assisted and self.draft_model is not None:
+            kwargs["assisted"] = True
+        return kwargs
+
+    def _load_draft_model(self, draft_model_name: str) -> nn.Module:
+        """Load the draft model and count its and the main model's forward passes."""
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_name)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"Draft model {draft_model_name} does not share the tokenizer of {self.model_name}")
+
+        draft_model = self._load_model(draft_model_name)
+        draft_model.eval()
+        draft_model.generation_config.num_assistant_tokens = int(os.getenv("RECLLM_DRAFT_TOKENS", "5"))
+        # Only the draft model's own forward passes are counted, not its submodules'
+        self.model.register_forward_hook(lambda *_: self._count_forward("target"))
+        draft_model.register_forward_hook(lambda *_: self._count_forward("draft"))
+        return draft_model
+
+    def _check_assisted(self):
+        """Warn if assisted greedy decoding does not reproduce plain greedy decoding."""
+        prompt = "The best way to learn a new topic from videos is"
+        kwargs = {"max_new_tokens": 16, "do_sample": False}
+        plain = self._generate_uncached(prompt, "assisted-check", **kwargs)
+        # The check's cached prefix is left to the cache's LRU eviction
+        assisted = self._generate_uncached(prompt, "assisted-check", assisted=True, **kwargs)
+        if assisted != plain:
+            logging.warning(
+                f"Assisted decoding with {self.draft_model_name} diverges from plain greedy decoding: "
+                f"{assisted!r} != {plain!r}"
+            )
+
+    def _count_forward(self, model: str):
+        self._forward_counts[model] += 1
+
+    def _record_assisted(self, forwards_before: Dict[str, int], generated_tokens: int):
+        """Derive draft acceptance from the forward passes of one assisted generation.
+
+        Each draft forward proposes one token and each target forward verifies
+        a run of them, keeping the accepted ones plus one token of its own.
+        Called under the model lock, so the forward counts are this call's.
+        """
+        target_forwards = self._forward_counts["target"] - forwards_before["target"]
+        draft_tokens = self._forward_counts["draft"] - forwards_before["draft"]
+        accepted_tokens = max(0, generated_tokens - target_forwards)
+
+        counters = self._assisted_counters
+        counters["generations"] += 1
+        counters["target_forwards"] += target_forwards
+        counters["draft_tokens"] += draft_tokens
+        counters["accepted_tokens"] += accepted_tokens
+        counters["generated_tokens"] += generated_tokens
+        ASSISTED_DECODING.inc(target_forwards, kind="target_forwards")
+        ASSISTED_DECODING.inc(draft_tokens, kind="draft_tokens")
+        ASSISTED_DECODING.inc(accepted_tokens, kind="accepted_tokens")
+        ASSISTED_DECODING.inc(generated_tokens, kind="generated_tokens")
+
+    def assisted_stats(self) -> Dict[str, float]:
+        """Draft acceptance rate and tokens per main-model forward pass of assisted generations."""
+        if self.draft_model is None:
+            return {}
+        with self._model_lock:
+            counters = dict(self._assisted_counters)
+        return {
+            **counters,
+            "acceptance_rate": counters["accepted_tokens"] / max(counters["draft_tokens"], 1),
+            "tokens_per_target_forward": counters["generated_tokens"] / max(counters["target_forwards"], 1)
+        }
+
+    def _stopping(self, generate_kwargs: Dict, prompt_length: int) -> Dict:
+        """Replace stop strings with a criterion that ignores them in leading whitespace."""
+        stop_strings = generate_kwargs.get("stop_strings")
+        if not stop_strings:
+            return generate_kwargs
+        kwargs = {key: value for key, value in generate_kwargs.items() if key != "stop_strings"}
+        kwargs["stopping_criteria"] = StoppingCriteriaList([
+            StopAfterTextCriteria(self.tokenizer, stop_strings, prompt_length)
+        ])
+        return kwargs
+
+    def _prefill(self, input_ids: List[int], session_id: Optional[str] = None) -> DynamicCache:
+        """Return a cache covering input_ids, reusing and updating the session's prefixes."""
+        use_prefix_cache = self.prefix_cache is not None and session_id is not None
+
+        cached_length, past_key_values = 0, None
+        if use_prefix_cache:
+            cached_length, past_key_values = self.prefix_cache.lookup(session_id, input_ids)
+            CACHE_LOOKUPS.inc(cache="prefix", result="hit" if cached_length else "miss")
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+
+        if cached_length < len(input_ids):
+            self.model(
+                input_ids=torch.tensor([input_ids[cached_length:]], dtype=torch.long, device=self.device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+            if use_prefix_cache:
+                self.prefix_cache.store(session_id, input_ids, past_key_values)
+
+        return past_key_values
+
+    def _count_tokens(self, prompt_tokens: int, generated_tokens: int, stage: Optional[str] = None):
+        """Attribute token counts to stage, by default the one being timed on this thread."""
+        stage = stage or current_stage()
+        TOKENS.inc(prompt_tokens, stage=stage, kind="prompt")
+        if generated_tokens:
+            TOKENS.inc(generated_tokens, stage=stage, kind="generated")
+
+    def _pad_batch(self, sequences: List[List[int]], padding_side: str) -> Dict[str, torch.Tensor]:
+        """Pad token id sequences into a batch on the model device."""
+        width = max(len(ids) for ids in sequences)
+        input_ids = torch.full(
+            (len(sequences), width), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            span = slice(0, len(ids)) if padding_side == "right" else slice(width - len(ids), width)
+            input_ids[row, span] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, span] = 1
+
+        return {
+            "input_ids": input_ids.to(self.device),
+            "attention_mask": attention_mask.to(self.device)
+        }
+
+    def _token_ids(self, prompts: List[Prompt]) -> List[List[int]]:
+        """Token ids of text or already assembled prompts.
+
+        Prompts are never truncated here: cutting them to a length would keep
+        their start and drop the latest turns, so conversations are windowed
+        to their stage's budget when the prompt is built instead.
+        """
+        texts = [prompt for prompt in prompts if isinstance(prompt, str)]
+        encoded = iter(self.tokenizer(texts)["input_ids"] if texts else [])
+        return [next(encoded) if isinstance(prompt, str) else list(prompt) for prompt in prompts]
+
+    def _encode_fragment(self, text: str) -> List[int]:
+        """Token ids for a prompt fragment, without special tokens."""
+        return self.tokenizer.encode(text, add_special_tokens=False)
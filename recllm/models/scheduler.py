@@ -0,0 +1,116 @@
+from typing import Dict, List, Tuple
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import logging
+import queue
+import threading
+import time
+from recllm.prompts.compiled import Prompt
+from recllm.utils.metrics import current_stage
+
+
+@dataclass(eq=False)
+class _Job:
+    prompt: Prompt
+    generate_kwargs: Dict
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Stage timed on the submitting thread, which the worker thread cannot see
+    stage: str = field(default_factory=current_stage)
+
+    @property
+    def key(self) -> Tuple:
+        """Jobs can share a batch only when their decoding parameters match."""
+        return tuple(sorted(self.generate_kwargs.items()))
+
+
+class InferenceScheduler:
+    """Queue generation jobs from all requests and run them as padded batches.
+
+    A worker thread waits for the first job, then keeps collecting jobs for up
+    to max_wait_ms or until max_batch_size compatible jobs are queued, and
+    runs them through RecLLM.generate_batch in a single call.
+    """
+
+    def __init__(self, rec_llm, max_batch_size: int = 8, max_wait_ms: float = 10.0):
+        self.rec_llm = rec_llm
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue: "queue.Queue[_Job]" = queue.Queue()
+        self._pending: List[_Job] = []
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._batched_jobs = 0
+        self._queue_wait_seconds = 0.0
+        self._worker = threading.Thread(target=self._run, name="recllm-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt: Prompt, **generate_kwargs) -> Future:
+        """Queue a prompt for generation; the future resolves to the new text."""
+        job = _Job(prompt, generate_kwargs)
+        self._queue.put(job)
+        return job.future
+
+    def generate(self, prompt: Prompt, **generate_kwargs) -> str:
+        """Queue a prompt and block until its batch has been generated."""
+        return self.submit(prompt, **generate_kwargs).result()
+
+    def stats(self) -> Dict[str, float]:
+        """Return queue depth and batch occupancy counters."""
+        with self._stats_lock:
+            batches, jobs = self._batches, self._batched_jobs
+            return {
+                "queue_depth": self._queue.qsize() + len(self._pending),
+                "batches": batches,
+                "jobs": jobs,
+                "mean_batch_size": jobs / batches if batches else 0.0,
+                "mean_batch_occupancy": jobs / (batches * self.max_batch_size) if batches else 0.0,
+                "mean_queue_wait_ms": 1000 * self._queue_wait_seconds / jobs if jobs else 0.0
+            }
+
+    def _run(self):
+        while True:
+            if not self._pending:
+                self._pending.append(self._queue.get())
+
+            deadline = self._pending[0].enqueued_at + self.max_wait_ms / 1000
+            while len(self._pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    self._pending.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Serve the oldest job's group; incompatible jobs wait for the next round
+            key = self._pending[0].key
+            batch = [job for job in self._pending if job.key == key][:self.max_batch_size]
+            self._pending = [job for job in self._pending if job not in batch]
+            self._execute(batch)
+
+    def _execute(self, batch: List[_Job]):
+        started = time.monotonic()
+        try:
+            outputs = self.rec_llm.generate_batch(
+                [job.prompt for job in batch],
+                stages=[job.stage for job in batch],
+                **batch[0].generate_kwargs
+            )
+        except Exception as e:
+            logging.error(f"Error in scheduled batch of {len(batch)}: {str(e)}", exc_info=True)
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        for job, output in zip(batch, outputs):
+            job.future.set_result(output)
+
+        with self._stats_lock:
+            self._batches += 1
+            self._batched_jobs += len(batch)
+            self._queue_wait_seconds += sum(started - job.enqueued_at for job in batch)
+        logging.debug(
+            f"Generated batch of {len(batch)}/{self.max_batch_size} "
+            f"in {time.monotonic() - started:.2f}s, queue depth {self._queue.qsize()}"
+        )
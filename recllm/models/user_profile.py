@@ -1,12 +1,17 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import json
+import logging
+import threading
 from datetime import datetime
 from recllm.prompts.templates import (
     PREFERENCE_EXTRACTION_PROMPT,
     PROFILE_INTEGRATION_PROMPT,
-    FEEDBACK_INTEGRATION_PROMPT,
-    PROFILE_MERGE_PROMPT
+    FEEDBACK_BATCH_INTEGRATION_PROMPT,
+    PROFILE_MERGE_PROMPT,
+    PROFILE_COMPACTION_PROMPT
 )
+from recllm.models.watch_history import WatchHistory
+from recllm.utils.metrics import timed
 
 class UserProfile:
     def __init__(self, user_id: str):
@@ -14,9 +19,18 @@ class UserProfile:
         # Interpretable natural language user profiles
         self.profile_description = "" 
         # Imitation of user watch history NOTE: Not fully implemented
-        self.watch_history: List[Dict] = []
+        self.watch_history = WatchHistory()
         self.last_updated = datetime.now()
+        # Bumped with every description update so readers can detect changes
+        self.version = 0
+        # Version last loaded from or written to storage
+        self.saved_version = 0
+        # Token ids of the description and the version they were encoded at
+        self._description_ids: Optional[Tuple[int, List[int]]] = None
+        self._compacting = False
+        self._lock = threading.Lock()
     
+    @timed("conversation_update")
     def update_profile_from_conversation(
         self,
         conversation_history: List[Dict[str, str]],
@@ -31,30 +45,16 @@ class UserProfile:
         prompt = PREFERENCE_EXTRACTION_PROMPT.format(
             conversation_history=conv_str
         )
-        new_insights = llm_model.generate_response([{"role": "system", "content": prompt}])
-        
-        # Combine existing profile with new insights
-        if self.profile_description:
-            merge_prompt = PROFILE_MERGE_PROMPT.format(
-                current_profile=self.profile_description,
-                new_insights=new_insights
-            )
-            
-            self.profile_description = llm_model.generate_response(
-                [{"role": "system", "content": merge_prompt}]
-            )
-        else:
-            self.profile_description = new_insights
-        
-        self.last_updated = datetime.now()
+        new_insights = llm_model.generate_response(
+            [{"role": "system", "content": prompt}],
+            session_id=self.user_id,
+            stage="profile_update"
+        )
+        self._merge_insights(new_insights, llm_model)
     
     def add_to_watch_history(self, video_data: Dict):
         """Add a video to the user's watch history."""
-        watch_entry = {
-            **video_data,
-            "watched_at": datetime.now().isoformat()
-        }
-        self.watch_history.append(watch_entry)
+        self.watch_history.append(video_data)
     
     def get_relevant_profile_aspects(
         self,
@@ -63,12 +63,102 @@ class UserProfile:
     ) -> str:
         """Extract relevant aspects of the user profile for the current context."""
         prompt = PROFILE_INTEGRATION_PROMPT.format(
-            user_profile=self.profile_description,
+            user_profile=self.prompt_description(llm_model),
             context=context
         )
         
-        return llm_model.generate_response([{"role": "system", "content": prompt}])
+        return llm_model.generate_response(
+            [{"role": "system", "content": prompt}],
+            session_id=self.user_id,
+            stage="profile_aspects",
+            cache_tag=self.cache_tag
+        )
     
+    def description_ids(self, tokenizer) -> List[int]:
+        """Token ids of the description, encoded once per version."""
+        with self._lock:
+            version, description, cached = self.version, self.profile_description, self._description_ids
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        ids = tokenizer.encode(description, add_special_tokens=False)
+        with self._lock:
+            if self.version == version:
+                self._description_ids = (version, ids)
+        return ids
+
+    def prompt_description(self, llm_model) -> str:
+        """The description as injected into prompts, within the model's profile token budget.
+
+        Until an over-budget description is compacted, prompts get its start.
+        """
+        description = self.profile_description
+        budget = llm_model.profile_token_budget
+        ids = self.description_ids(llm_model.tokenizer)
+        if not budget or len(ids) <= budget:
+            return description
+        return llm_model.tokenizer.decode(ids[:budget])
+
+    def compact(self, llm_model) -> bool:
+        """Re-summarise the description if it exceeds the model's profile token budget.
+
+        The summary is cut to the budget if the model overshoots, and dropped
+        if generation fails, comes back empty or the description changed
+        while it was generated. Returns whether the description was replaced.
+        """
+        budget = llm_model.profile_token_budget
+        if not budget or len(self.description_ids(llm_model.tokenizer)) <= budget:
+            return False
+
+        with self._lock:
+            if self._compacting:
+                return False
+            self._compacting = True
+            version, description = self.version, self.profile_description
+
+        try:
+            prompt = PROFILE_COMPACTION_PROMPT.format(
+                profile=description,
+                # Roughly three words per four tokens
+                max_words=budget * 3 // 4
+            )
+            try:
+                compacted = llm_model.generate_response(
+                    [{"role": "system", "content": prompt}],
+                    max_new_tokens=budget,
+                    session_id=self.user_id,
+                    stage="profile_compaction",
+                    raise_errors=True
+                ).strip()
+            except Exception as e:
+                logging.warning(f"Keeping the profile of {self.user_id} uncompacted: {str(e)}")
+                return False
+            if not compacted:
+                return False
+
+            compacted_ids = llm_model.tokenizer.encode(compacted, add_special_tokens=False)
+            if len(compacted_ids) > budget:
+                compacted = llm_model.tokenizer.decode(compacted_ids[:budget])
+                # Re-encoding the cut text may not give back the same ids
+                compacted_ids = llm_model.tokenizer.encode(compacted, add_special_tokens=False)
+
+            with self._lock:
+                if self.version != version:
+                    return False
+                self.profile_description = compacted
+                self.version += 1
+                self.last_updated = datetime.now()
+                self._description_ids = (self.version, compacted_ids)
+            return True
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    @property
+    def cache_tag(self) -> str:
+        """Tag for cached LLM outputs; changes whenever the profile is updated."""
+        return f"{self.user_id}@{self.last_updated.isoformat()}"
+
     def update_profile_from_feedback(
         self,
         video_details: Dict,
@@ -76,47 +166,92 @@ class UserProfile:
         feedback_value: float,
         llm_model
     ):
-        """Update profile based on feedback using LLM."""
-        # Generate profile insights from feedback
-        prompt = FEEDBACK_INTEGRATION_PROMPT.format(
-            video_details=video_details,
-            feedback_type=feedback_type,
-            feedback_value=feedback_value,
+        """Update profile based on one feedback event using LLM."""
+        self.update_profile_from_feedback_batch(
+            [{
+                "video_details": video_details,
+                "feedback_type": feedback_type,
+                "feedback_value": feedback_value
+            }],
+            llm_model
+        )
+    
+    @timed("feedback_update")
+    def update_profile_from_feedback_batch(
+        self,
+        events: List[Dict],
+        llm_model
+    ):
+        """Update profile from several feedback events with one extraction and one merge.
+
+        Each event has `video_details`, `feedback_type` and `feedback_value`.
+        """
+        feedback_events = "\n".join([
+            f"- {event['feedback_type']} ({event['feedback_value']}): "
+            f"{event['video_details'].get('title', '')} "
+            f"by {event['video_details'].get('channel_title', '')}"
+            for event in events
+        ])
+        prompt = FEEDBACK_BATCH_INTEGRATION_PROMPT.format(
+            feedback_events=feedback_events,
             current_preferences=self.profile_description
         )
-        
-        new_insights = llm_model.generate_response([{"role": "system", "content": prompt}])
-        
-        # Merge new insights with existing profile
+
+        new_insights = llm_model.generate_response(
+            [{"role": "system", "content": prompt}],
+            session_id=self.user_id,
+            stage="profile_update"
+        )
+        self._merge_insights(new_insights, llm_model)
+
+    def _merge_insights(self, new_insights: str, llm_model):
+        """Merge new insights into the description, then compact it if over budget."""
         if self.profile_description:
             merge_prompt = PROFILE_MERGE_PROMPT.format(
                 current_profile=self.profile_description,
                 new_insights=new_insights
             )
-            
-            self.profile_description = llm_model.generate_response(
-                [{"role": "system", "content": merge_prompt}]
-            )
+
+            self._set_description(llm_model.generate_response(
+                [{"role": "system", "content": merge_prompt}],
+                session_id=self.user_id,
+                stage="profile_update"
+            ))
         else:
-            self.profile_description = new_insights
-        
-        self.last_updated = datetime.now()
-    
-    def to_dict(self) -> dict:
+            self._set_description(new_insights)
+        self.compact(llm_model)
+
+    def _set_description(self, description: str):
+        """Replace the description and bump the version together."""
+        with self._lock:
+            self.profile_description = description
+            self.version += 1
+            self.last_updated = datetime.now()
+
+    def modified(self) -> bool:
+        """Whether the description or watch history changed since the profile was loaded or saved."""
+        return self.version != self.saved_version or self.watch_history.has_pending()
+
+    def to_dict(self, include_history: bool = True) -> dict:
         """Convert profile to dictionary for storage."""
-        return {
+        data = {
             "user_id": self.user_id,
             "profile_description": self.profile_description,
-            "watch_history": self.watch_history,
+            "version": self.version,
             "last_updated": self.last_updated.isoformat()
         }
+        if include_history:
+            data["watch_history"] = self.watch_history.to_dict()
+        return data
     
     @classmethod
     def from_dict(cls, data: dict) -> "UserProfile":
         """Create profile from dictionary."""
         profile = cls(data["user_id"])
         profile.profile_description = data["profile_description"]
-        profile.watch_history = data["watch_history"]
+        profile.version = data.get("version", 0)
+        profile.saved_version = profile.version
+        profile.watch_history = WatchHistory.from_dict(data.get("watch_history", []))
         profile.last_updated = datetime.fromisoformat(data["last_updated"])
         
         return profile 
\ No newline at end of file
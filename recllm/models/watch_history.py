@@ -0,0 +1,161 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from array import array
+from datetime import datetime
+import os
+import threading
+import weakref
+
+# Only these video fields are kept for watched videos; descriptions, stats
+# and thumbnails are re-fetchable and dominate the size of a history entry.
+HISTORY_VIDEO_FIELDS = ("title", "channel_title", "published_at", "duration")
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("RECLLM_WATCH_HISTORY_LIMIT", "500"))
+
+
+class VideoMetadataTable:
+    """Process-wide table of compact video metadata, shared by all histories.
+
+    Each video id is interned once to a small integer so histories only
+    store integers, and its metadata is held once however many users watched it.
+    Entries are reference counted: a video is dropped once no history entry
+    refers to it, e.g. after its profiles are evicted from the cache, and
+    its index is reused.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index: Dict[str, int] = {}
+        self._ids: List[Optional[str]] = []
+        self._metadata: List[Dict] = []
+        self._refs: List[int] = []
+        self._free: List[int] = []
+
+    def intern(self, video_id: str, video_data: Optional[Dict] = None) -> int:
+        """Return the index of a video, taking a reference and recording its metadata if it is new."""
+        with self._lock:
+            index = self._index.get(video_id)
+            if index is None:
+                if self._free:
+                    index = self._free.pop()
+                    self._ids[index], self._metadata[index], self._refs[index] = video_id, {}, 0
+                else:
+                    index = len(self._ids)
+                    self._ids.append(video_id)
+                    self._metadata.append({})
+                    self._refs.append(0)
+                self._index[video_id] = index
+            self._refs[index] += 1
+            if video_data and not self._metadata[index]:
+                self._metadata[index] = {
+                    field: video_data[field]
+                    for field in HISTORY_VIDEO_FIELDS
+                    if field in video_data
+                }
+            return index
+
+    def release(self, indices) -> None:
+        """Drop one reference per index, forgetting videos no longer referenced."""
+        with self._lock:
+            for index in indices:
+                self._refs[index] -= 1
+                if self._refs[index] == 0:
+                    del self._index[self._ids[index]]
+                    self._ids[index], self._metadata[index] = None, {}
+                    self._free.append(index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def video_id(self, index: int) -> str:
+        return self._ids[index]
+
+    def metadata(self, index: int) -> Dict:
+        return self._metadata[index]
+
+
+VIDEO_METADATA = VideoMetadataTable()
+
+
+class WatchHistory:
+    """Bounded watch history stored as parallel arrays of video indices and timestamps.
+
+    Only the newest max_entries are kept. Entries appended since the last
+    mark_persisted() can be read with pending() for append-only storage.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, table: VideoMetadataTable = VIDEO_METADATA):
+        self.max_entries = max_entries
+        self.table = table
+        self._videos = array("q")
+        self._watched_at = array("d")
+        # Release this history's references when it is garbage collected
+        weakref.finalize(self, table.release, self._videos)
+        # Entries ever appended, and how many of those have been persisted
+        self._appended = 0
+        self._persisted = 0
+
+    def append(self, video_data: Dict, watched_at: Optional[float] = None) -> None:
+        """Record a watched video."""
+        self._videos.append(self.table.intern(video_data["id"], video_data))
+        self._watched_at.append(watched_at if watched_at is not None else datetime.now().timestamp())
+        self._appended += 1
+
+        overflow = len(self._videos) - self.max_entries
+        if overflow > 0:
+            self.table.release(self._videos[:overflow])
+            del self._videos[:overflow]
+            del self._watched_at[:overflow]
+
+    def pending(self) -> Tuple[List[Tuple[str, float, Dict]], int]:
+        """Return (entries not yet persisted, marker to pass to mark_persisted)."""
+        count = min(self._appended - self._persisted, len(self._videos))
+        start = len(self._videos) - count
+        entries = [
+            (self.table.video_id(index), timestamp, self.table.metadata(index))
+            for index, timestamp in zip(self._videos[start:], self._watched_at[start:])
+        ]
+        return entries, self._appended
+
+    def has_pending(self) -> bool:
+        return self._appended > self._persisted
+
+    def mark_persisted(self, marker: int) -> None:
+        """Record that every entry up to marker has been written to storage."""
+        self._persisted = max(self._persisted, marker)
+
+    def to_dict(self) -> Dict:
+        """Columnar form for storage, with the metadata of the referenced videos."""
+        return {
+            "video_ids": [self.table.video_id(index) for index in self._videos],
+            "watched_at": list(self._watched_at),
+            "videos": {
+                self.table.video_id(index): self.table.metadata(index)
+                for index in set(self._videos)
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data, max_entries: int = DEFAULT_MAX_ENTRIES) -> "WatchHistory":
+        """Load the columnar form, or the legacy list of full video dicts."""
+        history = cls(max_entries=max_entries)
+        if isinstance(data, list):
+            for entry in data:
+                history.append(entry, datetime.fromisoformat(entry["watched_at"]).timestamp())
+        else:
+            videos = data.get("videos", {})
+            for video_id, timestamp in zip(data["video_ids"], data["watched_at"]):
+                history.append({"id": video_id, **videos.get(video_id, {})}, timestamp)
+        history._persisted = history._appended
+        return history
+
+    def __len__(self) -> int:
+        return len(self._videos)
+
+    def __iter__(self) -> Iterator[Dict]:
+        """Yield entries oldest first as video dicts with a watched_at timestamp."""
+        for index, timestamp in zip(self._videos, self._watched_at):
+            yield {
+                "id": self.table.video_id(index),
+                **self.table.metadata(index),
+                "watched_at": datetime.fromtimestamp(timestamp).isoformat()
+            }
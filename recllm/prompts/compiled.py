@@ -0,0 +1,107 @@
+from typing import Dict, List, Optional, Sequence, Union
+from collections import OrderedDict
+from dataclasses import dataclass
+from string import Formatter
+import threading
+
+# A prompt is either text or the token ids it is already encoded to
+Prompt = Union[str, List[int]]
+
+
+@dataclass(frozen=True)
+class Slot:
+    """A named field of a compiled template.
+
+    max_tokens keeps only the first tokens of long values (e.g. video
+    descriptions); cached=False skips the field cache for values that are
+    rarely repeated.
+    """
+    name: str
+    max_tokens: Optional[int] = None
+    cached: bool = True
+
+
+class FieldEncoder:
+    """Tokenizes dynamic field values through an LRU shared by all templates.
+
+    Profiles, conversation contexts and video fields recur across stages,
+    candidates and requests, so most of them are tokenized only once.
+    """
+
+    def __init__(self, tokenizer, max_entries: int = 8192):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, text: str, cached: bool = True) -> List[int]:
+        if not cached:
+            return self.tokenizer.encode(text, add_special_tokens=False)
+
+        with self._lock:
+            ids = self._cache.get(text)
+            if ids is not None:
+                self._cache.move_to_end(text)
+                return ids
+
+        ids = self.tokenizer.encode(text, add_special_tokens=False)
+        with self._lock:
+            self._cache[text] = ids
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return ids
+
+
+class CompiledTemplate:
+    """A prompt template split once into pre-tokenized static segments and slots.
+
+    render() concatenates the cached ids of the static text with the ids of
+    each field, so only the fields are tokenized per call and the static
+    prefix is token-for-token identical across calls. A field is given as
+    text, or as ids when the caller already has them (e.g. the windowed
+    conversation). Spaces before a slot are encoded with the field, as the
+    tokenizer would when tokenizing the rendered string; ids may otherwise
+    differ from that at slot boundaries but decode to the same text.
+    """
+
+    def __init__(self, template: str, encoder: FieldEncoder, slots: Sequence[Slot] = ()):
+        self.template = template
+        self.encoder = encoder
+        tokenizer = encoder.tokenizer
+        # Special tokens the tokenizer adds in front of every text, e.g. BOS
+        self.prefix_ids = tokenizer("")["input_ids"]
+        declared = {slot.name: slot for slot in slots}
+
+        # Alternating static ids and slots: [ids, slot, ids, slot, ..., ids]
+        self._parts: List[Union[List[int], Slot]] = []
+        self._leads: Dict[str, str] = {}
+        self.slots: Dict[str, Slot] = {}
+        for literal, field_name, _, _ in Formatter().parse(template):
+            lead = ""
+            if field_name is not None:
+                stripped = literal.rstrip(" ")
+                lead, literal = literal[len(stripped):], stripped
+            self._parts.append(tokenizer.encode(literal, add_special_tokens=False) if literal else [])
+            if field_name is not None:
+                self.slots[field_name] = declared.get(field_name, Slot(field_name))
+                self._leads[field_name] = lead
+                self._parts.append(self.slots[field_name])
+
+    def render(self, **fields: Prompt) -> List[int]:
+        """Assemble the prompt's token ids; every slot must be given."""
+        missing = set(self.slots) - set(fields)
+        if missing:
+            raise KeyError(f"Missing template fields: {sorted(missing)}")
+
+        ids = list(self.prefix_ids)
+        for part in self._parts:
+            if not isinstance(part, Slot):
+                ids.extend(part)
+                continue
+            value = fields[part.name]
+            if isinstance(value, str):
+                value = self.encoder.encode(self._leads[part.name] + value, cached=part.cached)
+            elif self._leads[part.name]:
+                ids.extend(self.encoder.encode(self._leads[part.name]))
+            ids.extend(value[:part.max_tokens] if part.max_tokens is not None else value)
+        return ids
@@ -14,31 +14,55 @@ Previous conversation:
 User: {user_message}
 Assistant:"""
 
-SEARCH_QUERY_PROMPT = """Based on the conversation and user profile, generate a YouTube search query that will find relevant videos.
-Consider the user's preferred content style, depth, and format.
+# The search, ranking and response prompts open with the same conversation and
+# profile block so their KV cache prefix can be shared between stages and turns.
+
+SEARCH_QUERY_PROMPT = """Conversation:
+{conversation_history}
 
 User Profile:
 {user_profile}
 
-Conversation:
-{conversation_history}
+Based on the conversation and user profile, generate a YouTube search query that will find relevant videos.
+Consider the user's preferred content style, depth, and format.
 
 Generate a search query (only the query, no explanations):"""
 
-RANKING_PROMPT = """Rate how well this video matches the user's interests, preferred content style, and learning preferences.
-Consider factors like video length, presentation style, and depth of content.
-Provide a score from 0 to 1 (1 being perfect match) and a brief explanation.
+# Relevant profile aspects and search queries in one generation, replacing the
+# PROFILE_INTEGRATION_PROMPT and SEARCH_QUERY_PROMPT round trips
+PLANNING_PROMPT = """Conversation:
+{conversation_history}
+
+User Profile:
+{user_profile}
+
+Plan a YouTube search for the user's current request.
+First describe the aspects of the user profile relevant to this conversation in one or two sentences.
+Then write one to three YouTube search queries that will find suitable videos, one per line.
+Consider the user's preferred content style, depth, and format.
+
+Answer in exactly this format:
+Relevant preferences: [description]
+Queries:
+- [search query]
+- [search query]
+
+Relevant preferences:"""
+
+RANKING_PROMPT = """Conversation:
+{conversation_context}
+
+User Profile:
+{user_profile}
 
 Video:
 Title: {video_title}
 Description: {video_description}
 Channel: {channel_title}
 
-User Profile:
-{user_profile}
-
-Conversation Context:
-{conversation_context}
+Rate how well this video matches the user's interests, preferred content style, and learning preferences.
+Consider factors like video length, presentation style, and depth of content.
+Provide a score from 0 to 1 (1 being perfect match) and a brief explanation.
 
 Provide rating and explanation in this format:
 [score]
@@ -70,6 +94,15 @@ New insights:
 
 Generate a concise, coherent profile that combines both descriptions:"""
 
+PROFILE_COMPACTION_PROMPT = """Condense this user profile description to at most {max_words} words.
+Keep the most current and distinctive preferences: topics, content style, video length and depth, and presentation preferences.
+Drop repetition, filler and one-off details.
+
+Profile:
+{profile}
+
+Generate the condensed profile:"""
+
 PROFILE_INTEGRATION_PROMPT = """Given the user profile and current conversation context, extract the most relevant aspects of their preferences.
 Focus on aspects that would help find the most suitable videos for the current context.
 
@@ -81,31 +114,29 @@ Current Context:
 
 Describe the relevant preferences:"""
 
-RESPONSE_GENERATION_PROMPT = """Generate a natural, engaging response that introduces the recommended videos.
-Explain how each recommendation aligns with the user's content preferences and interests.
-Be concise but informative.
+RESPONSE_GENERATION_PROMPT = """Conversation:
+{conversation_history}
 
 User Profile:
 {user_profile}
 
-Conversation History:
-{conversation_history}
-
 Top Recommendations:
 {recommendations}
 
+Generate a natural, engaging response that introduces the recommended videos.
+Explain how each recommendation aligns with the user's content preferences and interests.
+Be concise but informative.
+
 Generate response (be natural and conversational):"""
 
-FEEDBACK_INTEGRATION_PROMPT = """Based on the user's feedback on this video, update our understanding of their preferences.
+FEEDBACK_BATCH_INTEGRATION_PROMPT = """Based on the user's recent feedback on these videos, update our understanding of their preferences.
 Consider how this feedback reveals their content preferences, interests, and viewing habits.
+Weigh consistent signals across several videos more than a single reaction.
 
-Video Details:
-{video_details}
-
-Feedback Type: {feedback_type}
-Feedback Value: {feedback_value}
+Recent Feedback:
+{feedback_events}
 
 Current User Profile:
 {current_preferences}
 
-Generate an updated profile description:""" 
\ No newline at end of file
+Generate an updated profile description:"""
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""Serve RecLLM from several worker processes sharing one copy of the model weights.
+
+The parent loads the model once and forks the workers, so the weights are
+shared copy-on-write and never written to; only per-process state (caches,
+executors, connections) is duplicated. All workers accept connections on
+one listening socket bound by the parent:
+
+    python -m recllm.serve --workers 4 --port 7860
+
+Profiles are cached per worker, so each worker validates its cached
+profiles against the store (RECLLM_PROFILE_VALIDATE=1 unless set). Metrics
+at /metrics are per worker.
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import torch
+import uvicorn
+from recllm import app as server
+from recllm.models.rec_llm import RecLLM
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(model: RecLLM, sock: socket.socket, threads: int):
+    """Build this worker's services around the inherited model and serve until stopped."""
+    torch.set_num_threads(threads)
+    server.load_services(model)
+    config = uvicorn.Config(server.app, log_level="info")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("RECLLM_WORKERS", "2")))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7860)
+    args = parser.parse_args()
+
+    os.environ.setdefault("RECLLM_PROFILE_VALIDATE", "1")
+    # OpenMP threads started before fork() would hang the workers' thread pools
+    torch.set_num_threads(1)
+    model = server.load_model()
+    # Keep the collector from touching (and so copying) the inherited objects
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # Split the cores between workers instead of oversubscribing them
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    workers = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                run_worker(model, sock, threads)
+            except Exception as e:
+                logger.error(f"Worker failed: {str(e)}", exc_info=True)
+                status = 1
+            os._exit(status)
+        workers.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(args.workers):
+        spawn()
+    logger.info(f"Serving on {args.host}:{args.port} with {args.workers} workers, {threads} threads each")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, restarting it")
+            spawn()
+
+    sock.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+from typing import Any, Callable, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import contextvars
+import os
+
+T = TypeVar("T")
+
+
+def _inference_workers() -> int:
+    workers = int(os.getenv("RECLLM_INFERENCE_WORKERS", "1"))
+    if os.getenv("RECLLM_BATCH_SCHEDULER", "0") == "1":
+        # Each worker blocks until its job's batch is done, so the scheduler
+        # can only ever batch as many jobs as there are workers
+        workers = max(workers, int(os.getenv("RECLLM_MAX_BATCH_SIZE", "8")))
+    return workers
+
+
+# A single inference thread owns the model so generations never contend for
+# it (unless the batch scheduler needs concurrent submitters), while blocking
+# network and disk work gets its own wider pool.
+INFERENCE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=_inference_workers(),
+    thread_name_prefix="recllm-inference"
+)
+IO_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RECLLM_IO_WORKERS", "8")),
+    thread_name_prefix="recllm-io"
+)
+
+
+async def run_inference(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking model call on the inference executor."""
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context over, e.g. the request's stage timings
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(INFERENCE_EXECUTOR, partial(context.run, func, *args, **kwargs))
+
+
+async def run_io(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run blocking network or file I/O on the I/O thread pool."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(IO_EXECUTOR, partial(context.run, func, *args, **kwargs))
+
+
+def shutdown_executors() -> None:
+    """Stop both pools, waiting for in-flight work."""
+    INFERENCE_EXECUTOR.shutdown(wait=True)
+    IO_EXECUTOR.shutdown(wait=True)
@@ -0,0 +1,116 @@
+from typing import Dict, List, Optional
+from concurrent.futures import Executor
+import logging
+import threading
+import time
+
+
+class FeedbackQueue:
+    """Background pipeline that folds feedback events into user profiles.
+
+    Events are acknowledged on submit and grouped per user. Once a user's
+    oldest pending event is window_seconds old, all of that user's events
+    are applied with a single batched extraction and merge, and the profile
+    is saved.
+    """
+
+    def __init__(
+        self,
+        rec_llm,
+        profile_store,
+        window_seconds: float = 2.0,
+        max_events_per_batch: int = 20,
+        executor: Optional[Executor] = None
+    ):
+        self.rec_llm = rec_llm
+        self.profile_store = profile_store
+        self.window_seconds = window_seconds
+        self.max_events_per_batch = max_events_per_batch
+        # Model work is submitted here so it queues with request inference
+        self.executor = executor
+        self._pending: Dict[str, List[Dict]] = {}
+        self._due: Dict[str, float] = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._counters = {"events": 0, "batches": 0, "failed_batches": 0}
+        self._worker = threading.Thread(target=self._run, name="feedback-queue", daemon=True)
+        self._worker.start()
+
+    def submit(
+        self,
+        user_id: str,
+        video_details: Dict,
+        feedback_type: str,
+        feedback_value: float
+    ):
+        """Queue one feedback event for the user's next batch."""
+        with self._condition:
+            self._pending.setdefault(user_id, []).append({
+                "video_details": video_details,
+                "feedback_type": feedback_type,
+                "feedback_value": feedback_value
+            })
+            self._due.setdefault(user_id, time.monotonic() + self.window_seconds)
+            self._counters["events"] += 1
+            self._condition.notify()
+
+    def stats(self) -> Dict[str, int]:
+        """Return queued event and processed batch counters."""
+        with self._condition:
+            return {
+                **self._counters,
+                "pending_users": len(self._pending),
+                "pending_events": sum(len(events) for events in self._pending.values())
+            }
+
+    def close(self):
+        """Stop accepting time-based batches and apply everything still queued."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.monotonic()
+                    if any(due <= now for due in self._due.values()):
+                        break
+                    timeout = min(self._due.values()) - now if self._due else None
+                    self._condition.wait(timeout)
+
+                now = time.monotonic()
+                ready = [
+                    user_id for user_id, due in self._due.items()
+                    if self._closed or due <= now
+                ]
+                batches = {}
+                for user_id in ready:
+                    del self._due[user_id]
+                    batches[user_id] = self._pending.pop(user_id)
+                closed = self._closed
+
+            for user_id, events in batches.items():
+                self._apply(user_id, events)
+            if closed:
+                return
+
+    def _apply(self, user_id: str, events: List[Dict]):
+        try:
+            profile = self.profile_store.get_profile(user_id)
+            for start in range(0, len(events), self.max_events_per_batch):
+                batch = events[start:start + self.max_events_per_batch]
+                if self.executor is not None:
+                    self.executor.submit(
+                        profile.update_profile_from_feedback_batch, batch, self.rec_llm
+                    ).result()
+                else:
+                    profile.update_profile_from_feedback_batch(batch, self.rec_llm)
+            self.profile_store.save_profile(user_id, profile)
+            with self._condition:
+                self._counters["batches"] += 1
+        except Exception as e:
+            logging.error(f"Error applying feedback for {user_id}: {str(e)}", exc_info=True)
+            with self._condition:
+                self._counters["failed_batches"] += 1
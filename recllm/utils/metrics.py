@@ -0,0 +1,200 @@
+"""Process-wide counters and histograms, rendered in the Prometheus text format.
+
+Pipeline stages are timed with `timed(stage)`. Besides the stage duration
+histogram, it records the stage as the current one of the calling thread,
+so token counts can be attributed to it. The stage's duration is also
+added to the timings of the enclosing request when one is being tracked
+(see `track_request`).
+"""
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """A monotonically increasing total per label combination."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return super().render() + [
+            f"{self.name}{_format_labels(key)} {value}" for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets per label combination."""
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label key: [bucket counts..., +Inf count], sum
+        self._values: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = super().render()
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The set of metrics exposed together at /metrics."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "recllm_stage_seconds", "Duration of pipeline stages", ["stage"]
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "recllm_request_seconds", "Duration of HTTP requests until the response starts", ["route", "status"]
+))
+TOKENS = REGISTRY.register(Counter(
+    "recllm_tokens_total", "Prompt tokens processed and tokens generated", ["stage", "kind"]
+))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "recllm_cache_lookups_total", "Cache lookups by cache and result (hit, stale, miss)", ["cache", "result"]
+))
+API_CALLS = REGISTRY.register(Counter(
+    "recllm_youtube_api_calls_total", "YouTube Data API requests by method and outcome", ["method", "status"]
+))
+ASSISTED_DECODING = REGISTRY.register(Counter(
+    "recllm_assisted_decoding_total",
+    "Assisted generation: target and draft forward passes, generated and accepted draft tokens",
+    ["kind"]
+))
+LOCAL_RETRIEVAL = REGISTRY.register(Counter(
+    "recllm_local_retrieval_total",
+    "Searches served from the local video index by reason (hybrid, local, quota, empty)",
+    ["reason"]
+))
+
+_local = threading.local()
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("recllm_request_timings", default=None)
+_timings_lock = threading.Lock()
+
+
+def current_stage() -> str:
+    """The innermost stage being timed on this thread, or "other"."""
+    return getattr(_local, "stage", None) or "other"
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time a block as a pipeline stage."""
+    previous = getattr(_local, "stage", None)
+    _local.stage = stage
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _local.stage = previous
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            with _timings_lock:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def track_request() -> Iterator[Dict[str, float]]:
+    """Collect the total seconds per stage of the current request.
+
+    Work run in executor threads is included when the context is carried
+    over, as recllm.utils.executors does.
+    """
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Format stage timings as a Server-Timing header value (milliseconds)."""
+    with _timings_lock:
+        items = sorted(timings.items())
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in items)
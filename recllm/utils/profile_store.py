@@ -1,42 +1,404 @@
 import os
+import fcntl
 import json
-from typing import Dict
+import sqlite3
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+from contextlib import contextmanager
 from recllm.models.user_profile import UserProfile
+from recllm.models.watch_history import DEFAULT_MAX_ENTRIES
+from recllm.utils.metrics import timed
 
-class ProfileStore:
-    def __init__(self):
+class JSONFileBackend:
+    """One JSON file per user, replaced atomically on every write.
+
+    A file's (inode, mtime) pair is its stamp: every write replaces the
+    file, so the stamp changes whenever any process saves the profile.
+    Conditional writes hold a per-user lock file between checking the
+    stamp and replacing the file.
+    """
+
+    def __init__(self, storage_dir: str = "/tmp/profiles"):
         # Use /tmp for storage in container
-        self.storage_dir = "/tmp/profiles"
+        self.storage_dir = storage_dir
         os.makedirs(self.storage_dir, exist_ok=True)
-        self._cache: Dict[str, UserProfile] = {}
 
+    def load(self, user_id: str) -> Optional[dict]:
+        profile_path = self._path(user_id)
+        if not os.path.exists(profile_path):
+            return None
+        with open(profile_path, 'r') as f:
+            return json.load(f)
+
+    def stamp(self, user_id: str) -> Optional[Hashable]:
+        try:
+            return self._stamp(os.stat(self._path(user_id)))
+        except FileNotFoundError:
+            return None
+
+    def save_many(
+        self,
+        profiles: Dict[str, UserProfile],
+        expected: Optional[Dict[str, Hashable]] = None
+    ) -> Dict[str, Hashable]:
+        """Write profiles and return their new stamps.
+
+        With expected, a profile is only written while its stored stamp is
+        still the expected one (None: not stored yet); the others are left
+        out of the result.
+        """
+        stamps = {}
+        for user_id, profile in profiles.items():
+            with self._user_lock(user_id, expected is not None):
+                if expected is not None and self.stamp(user_id) != expected.get(user_id):
+                    continue
+                _, marker = profile.watch_history.pending()
+                fd, tmp_path = tempfile.mkstemp(dir=self.storage_dir, suffix=".tmp")
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(profile.to_dict(), f)
+                        f.flush()
+                        # The rename keeps inode and mtime, so this is the stamp readers will see
+                        stamps[user_id] = self._stamp(os.fstat(f.fileno()))
+                    os.replace(tmp_path, self._path(user_id))
+                except Exception:
+                    os.unlink(tmp_path)
+                    raise
+                profile.watch_history.mark_persisted(marker)
+        return stamps
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _stamp(stat: os.stat_result) -> Hashable:
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{user_id}.json")
+
+    @contextmanager
+    def _user_lock(self, user_id: str, exclusive: bool):
+        if not exclusive:
+            yield
+            return
+        with open(os.path.join(self.storage_dir, f"{user_id}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class SQLiteBackend:
+    """All profiles in one SQLite database in WAL mode; each flush is one transaction.
+
+    Watch history is stored append-only: a save inserts only the entries
+    added since the previous save, plus metadata for videos not seen before.
+    Each profile row carries a revision, incremented on every save, as its
+    stamp; conditional writes compare it inside the write transaction.
+    """
+
+    def __init__(self, path: str = "/tmp/profiles.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS watch_history (user_id TEXT NOT NULL, video_id TEXT NOT NULL, watched_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS watch_history_user ON watch_history (user_id);
+            CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(profiles)")}
+        if "revision" not in columns:
+            # Databases created before revisions existed
+            self._db.execute("ALTER TABLE profiles ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+        self._db.commit()
+
+    def stamp(self, user_id: str) -> Optional[Hashable]:
+        with self._lock:
+            return self._revision(user_id)
+
+    def load(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM profiles WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            history = self._db.execute(
+                "SELECT h.video_id, h.watched_at, v.data FROM watch_history h "
+                "LEFT JOIN videos v ON v.video_id = h.video_id "
+                "WHERE h.user_id = ? ORDER BY h.rowid DESC LIMIT ?",
+                (user_id, DEFAULT_MAX_ENTRIES)
+            ).fetchall()[::-1]
+
+        data = json.loads(row[0])
+        data["watch_history"] = {
+            "video_ids": [video_id for video_id, _, _ in history],
+            "watched_at": [watched_at for _, watched_at, _ in history],
+            "videos": {
+                video_id: json.loads(video) for video_id, _, video in history if video
+            }
+        }
+        return data
+
+    def save_many(
+        self,
+        profiles: Dict[str, UserProfile],
+        expected: Optional[Dict[str, Hashable]] = None
+    ) -> Dict[str, Hashable]:
+        """Write profiles in one transaction and return their new revisions.
+
+        With expected, a profile is only written while its stored revision
+        is still the expected one (None: not stored yet); the others are
+        left out of the result.
+        """
+        with self._lock, self._db:
+            # Take the write lock before comparing revisions
+            self._db.execute("BEGIN IMMEDIATE")
+            if expected is not None:
+                profiles = {
+                    user_id: profile for user_id, profile in profiles.items()
+                    if self._revision(user_id) == expected.get(user_id)
+                }
+            markers = self._write(profiles)
+            # Read back inside the write transaction, before any other writer
+            stamps = {user_id: self._revision(user_id) for user_id in profiles}
+
+        for profile, marker in markers:
+            profile.watch_history.mark_persisted(marker)
+        return stamps
+
+    def _revision(self, user_id: str) -> Optional[int]:
+        row = self._db.execute("SELECT revision FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, profiles: Dict[str, UserProfile]) -> List[Tuple[UserProfile, int]]:
+        rows, history, videos, markers = [], [], [], []
+        for user_id, profile in profiles.items():
+            rows.append((user_id, json.dumps(profile.to_dict(include_history=False))))
+            entries, marker = profile.watch_history.pending()
+            markers.append((profile, marker))
+            for video_id, watched_at, metadata in entries:
+                history.append((user_id, video_id, watched_at))
+                videos.append((video_id, json.dumps(metadata)))
+
+        self._db.executemany(
+            "INSERT INTO profiles (user_id, data, revision) VALUES (?, ?, 1) "
+            "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, revision = revision + 1",
+            rows
+        )
+        self._db.executemany(
+            "INSERT OR IGNORE INTO videos (video_id, data) VALUES (?, ?)", videos
+        )
+        self._db.executemany(
+            "INSERT INTO watch_history (user_id, video_id, watched_at) VALUES (?, ?, ?)", history
+        )
+        # Keep the stored history within the same bound as the in-memory one
+        for user_id in {user_id for user_id, _, _ in history}:
+            self._db.execute(
+                "DELETE FROM watch_history WHERE user_id = ? AND rowid NOT IN "
+                "(SELECT rowid FROM watch_history WHERE user_id = ? ORDER BY rowid DESC LIMIT ?)",
+                (user_id, user_id, profiles[user_id].watch_history.max_entries)
+            )
+        return markers
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# Conditional writes retried per flush after another process saved the same profile
+SAVE_ATTEMPTS = 3
+
+BACKENDS = {
+    "json": JSONFileBackend,
+    "sqlite": SQLiteBackend
+}
+
+class ProfileStore:
+    def __init__(
+        self,
+        backend=None,
+        max_cached_profiles: int = 10000,
+        write_behind_seconds: float = 0.0,
+        validate_cache: bool = False
+    ):
+        """Profile cache in front of a storage backend.
+
+        The cache holds at most max_cached_profiles users (LRU). With
+        write_behind_seconds > 0, saves are queued and flushed by a background
+        thread at that interval, so repeated saves of one user coalesce into
+        a single write.
+
+        With validate_cache, a cached profile is only served while the
+        backend's stamp for it is the one it was loaded or saved with;
+        otherwise another process has saved the user since, and the profile
+        is reloaded. Saves are then conditional on that stamp too: a profile
+        saved elsewhere meanwhile is reloaded and this copy's changes are
+        merged into it before writing again. Use it whenever several
+        processes share one backend.
+        """
+        self.backend = backend or JSONFileBackend()
+        self.max_cached_profiles = max_cached_profiles
+        self.write_behind_seconds = write_behind_seconds
+        self.validate_cache = validate_cache
+        self._cache: "OrderedDict[str, UserProfile]" = OrderedDict()
+        self._dirty: Dict[str, UserProfile] = {}
+        # Backend stamp each cached profile corresponds to
+        self._stamps: Dict[str, Hashable] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+        if write_behind_seconds > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="profile-flusher", daemon=True)
+            self._flusher.start()
+
+    @classmethod
+    def from_env(cls) -> "ProfileStore":
+        """Build a store from RECLLM_PROFILE_* environment variables."""
+        backend_name = os.getenv("RECLLM_PROFILE_BACKEND", "json")
+        location = os.getenv("RECLLM_PROFILE_PATH")
+        backend_cls = BACKENDS[backend_name]
+        backend = backend_cls(location) if location else backend_cls()
+        return cls(
+            backend=backend,
+            max_cached_profiles=int(os.getenv("RECLLM_PROFILE_CACHE_SIZE", "10000")),
+            write_behind_seconds=float(os.getenv("RECLLM_PROFILE_WRITE_BEHIND", "0")),
+            validate_cache=os.getenv("RECLLM_PROFILE_VALIDATE", "0") == "1"
+        )
+
+    @timed("profile_load")
     def get_profile(self, user_id: str) -> UserProfile:
         """Get or create a user profile."""
-        if user_id in self._cache:
-            return self._cache[user_id]
+        with self._lock:
+            # Unsaved changes are always the newest version
+            profile = self._dirty.get(user_id) or self._cache.get(user_id)
+            expected = self._stamps.get(user_id)
+            if profile is not None and (not self.validate_cache or user_id in self._dirty):
+                self._remember(user_id, profile)
+                return profile
 
-        profile_path = os.path.join(self.storage_dir, f"{user_id}.json")
-        
-        if os.path.exists(profile_path):
-            try:
-                with open(profile_path, 'r') as f:
-                    data = json.load(f)
-                profile = UserProfile.from_dict(data)
-            except Exception:
-                profile = UserProfile(user_id)
-        else:
+        # Read the stamp before the data: a save in between only causes an extra reload
+        stamp = self.backend.stamp(user_id) if self.validate_cache else None
+        if profile is not None and stamp == expected:
+            with self._lock:
+                self._remember(user_id, profile)
+            return profile
+
+        try:
+            data = self.backend.load(user_id)
+            profile = UserProfile.from_dict(data) if data else UserProfile(user_id)
+        except Exception:
             profile = UserProfile(user_id)
-        
-        self._cache[user_id] = profile
+
+        with self._lock:
+            current = self._dirty.get(user_id) or self._cache.get(user_id)
+            # Another thread may have loaded (or saved) the same version meanwhile
+            if current is not None and (user_id in self._dirty or self._stamps.get(user_id) == stamp):
+                profile = current
+            else:
+                self._stamps[user_id] = stamp
+            self._remember(user_id, profile)
         return profile
 
     def save_profile(self, user_id: str, profile: UserProfile):
-        """Save a user profile to storage."""
-        profile_path = os.path.join(self.storage_dir, f"{user_id}.json")
-        
-        try:
-            with open(profile_path, 'w') as f:
-                json.dump(profile.to_dict(), f)
-            self._cache[user_id] = profile
-        except Exception as e:
-            print(f"Error saving profile: {e}") 
\ No newline at end of file
+        """Save a user profile to storage, or queue it when write-behind is enabled.
+
+        Profiles unchanged since they were loaded or last saved are not written.
+        """
+        with self._lock:
+            self._remember(user_id, profile)
+            if not profile.modified():
+                return
+            self._dirty[user_id] = profile
+
+        if self._flusher is None:
+            self.flush()
+
+    @timed("profile_flush")
+    def flush(self):
+        """Write every queued profile to the backend."""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+
+            try:
+                for attempt in range(SAVE_ATTEMPTS):
+                    versions = {user_id: profile.version for user_id, profile in dirty.items()}
+                    expected = None
+                    if self.validate_cache:
+                        with self._lock:
+                            expected = {user_id: self._stamps.get(user_id) for user_id in dirty}
+                    stamps = self.backend.save_many(dirty, expected)
+                    for user_id, stamp in stamps.items():
+                        dirty[user_id].saved_version = versions[user_id]
+                    with self._lock:
+                        self._stamps.update(stamps)
+
+                    conflicts = {user_id: profile for user_id, profile in dirty.items() if user_id not in stamps}
+                    if not conflicts:
+                        break
+                    dirty = {user_id: self._merge_stored(user_id, profile) for user_id, profile in conflicts.items()}
+                else:
+                    raise RuntimeError(f"Profiles kept changing while being saved: {sorted(dirty)}")
+            except Exception as e:
+                logging.error(f"Error saving profiles: {e}", exc_info=True)
+                with self._lock:
+                    # Keep failed writes queued unless a newer save superseded them
+                    for user_id, profile in dirty.items():
+                        self._dirty.setdefault(user_id, profile)
+
+    def close(self):
+        """Stop the background flusher and write out pending saves."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self.backend.close()
+
+    def _merge_stored(self, user_id: str, profile: UserProfile) -> UserProfile:
+        """Reload a profile another process saved meanwhile and apply this copy's changes to it.
+
+        The newer of the two descriptions wins if both changed; watch
+        history entries not yet saved are appended to the stored history.
+        """
+        stamp = self.backend.stamp(user_id)
+        data = self.backend.load(user_id)
+        if data is None:
+            merged = profile
+        else:
+            merged = UserProfile.from_dict(data)
+            if profile.version != profile.saved_version and (
+                merged.version == profile.saved_version or profile.last_updated > merged.last_updated
+            ):
+                merged._set_description(profile.profile_description)
+            entries, _ = profile.watch_history.pending()
+            for video_id, watched_at, metadata in entries:
+                merged.watch_history.append({"id": video_id, **metadata}, watched_at)
+
+        with self._lock:
+            self._stamps[user_id] = stamp
+            # Readers get the merged copy from now on, unless a newer save is queued
+            if user_id not in self._dirty:
+                self._remember(user_id, merged)
+        return merged
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.write_behind_seconds):
+            self.flush()
+
+    def _remember(self, user_id: str, profile: UserProfile):
+        self._cache[user_id] = profile
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_cached_profiles:
+            # Dirty profiles stay reachable through _dirty until flushed
+            evicted, _ = self._cache.popitem(last=False)
+            self._stamps.pop(evicted, None)
@@ -0,0 +1,145 @@
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import sqlite3
+import threading
+import time
+from recllm.utils.metrics import CACHE_LOOKUPS
+
+# Background revalidation shares a small pool across all caches
+_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="recllm-cache-refresh")
+
+
+class ResponseCache:
+    """Two-tier TTL cache: an in-memory LRU in front of an optional SQLite store.
+
+    Entries younger than ttl_seconds are fresh. Older entries are still served
+    for up to max_stale_seconds while a background refresh replaces them
+    (stale-while-revalidate); past that they count as misses. Values must be
+    JSON-serialisable to reach the disk tier.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl_seconds: float,
+        max_entries: int = 1024,
+        max_stale_seconds: float = 0.0,
+        disk_path: Optional[str] = None
+    ):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_stale_seconds = max_stale_seconds
+        self._memory: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "disk_hits": 0}
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(namespace TEXT, key TEXT, value TEXT, stored_at REAL, PRIMARY KEY (namespace, key))"
+            )
+            self._db.commit()
+
+    def lookup(self, key: str) -> Tuple[Optional[Any], bool]:
+        """Return (value, is_fresh); value is None on a miss or an expired entry."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, stored_at FROM cache WHERE namespace = ? AND key = ?",
+                    (self.name, key)
+                ).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+                    self._counters["disk_hits"] += 1
+                    self._remember(key, entry)
+
+            if entry is None or now - entry[1] > self.ttl_seconds + self.max_stale_seconds:
+                self._counters["misses"] += 1
+                CACHE_LOOKUPS.inc(cache=self.name, result="miss")
+                return None, False
+
+            fresh = now - entry[1] <= self.ttl_seconds
+            self._counters["hits" if fresh else "stale_hits"] += 1
+            CACHE_LOOKUPS.inc(cache=self.name, result="hit" if fresh else "stale")
+            return entry[0], fresh
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a value in both tiers."""
+        entry = (value, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO cache (namespace, key, value, stored_at) VALUES (?, ?, ?, ?)",
+                        (self.name, key, json.dumps(value), entry[1])
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logging.warning(f"Could not persist {self.name} cache entry: {e}")
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        """Serve from cache, revalidating stale entries; fetch and store on a miss.
+
+        Empty results (None, [], {}) are returned but not cached, since they
+        usually mean the upstream call failed.
+        """
+        value, fresh = self.lookup(key)
+        if value is not None:
+            if not fresh:
+                self.revalidate(key, lambda: self._store_if_present(key, fetch()))
+            return value
+
+        value = fetch()
+        self._store_if_present(key, value)
+        return value
+
+    def revalidate(self, token: Hashable, refresh: Callable[[], None]) -> None:
+        """Run refresh in the background unless one for the same token is in flight."""
+        with self._lock:
+            if token in self._refreshing:
+                return
+            self._refreshing.add(token)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logging.warning(f"Background refresh of {self.name} cache failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(token)
+
+        _REFRESH_EXECUTOR.submit(run)
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss counters and the memory tier size."""
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["stale_hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._memory),
+                "hit_rate": (lookups - self._counters["misses"]) / lookups if lookups else 0.0
+            }
+
+    def _store_if_present(self, key: str, value: Any) -> None:
+        if value:
+            self.set(key, value)
+
+    def _remember(self, key: str, entry: Tuple[Any, float]) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
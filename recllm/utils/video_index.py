@@ -0,0 +1,166 @@
+from typing import Dict, Iterable, List, Optional
+from collections import Counter, OrderedDict
+import json
+import math
+import re
+import sqlite3
+import threading
+from recllm.utils.metrics import timed
+
+# Title terms count twice: titles are short and the most descriptive field
+FIELD_WEIGHTS = {"title": 2, "channel_title": 1, "description": 1}
+
+_TERM = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TERM.findall(text.lower())
+
+
+class VideoIndex:
+    """BM25 index over the title, channel and description of every video seen.
+
+    Videos are added as the YouTube client fetches their details, up to
+    max_videos; the least recently fetched are evicted first. With a path,
+    videos are also stored in SQLite and the index is rebuilt from it in a
+    background thread on start, so searches meanwhile see a partial index.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_videos: int = 50000,
+        k1: float = 1.2,
+        b: float = 0.75
+    ):
+        self.path = path
+        self.max_videos = max_videos
+        self.k1 = k1
+        self.b = b
+        self._videos: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lengths: Dict[str, int] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            self._db.commit()
+            threading.Thread(target=self._load, name="video-index-loader", daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self._videos)
+
+    def add_many(self, videos: Iterable[Dict]) -> None:
+        """Index new or changed videos and persist them in one transaction."""
+        with self._lock:
+            changed = []
+            for video in videos:
+                if self._videos.get(video["id"]) == video:
+                    self._videos.move_to_end(video["id"])
+                else:
+                    changed.append(video)
+                    self._index(video)
+            evicted = self._evict()
+            if self._db is not None and (changed or evicted):
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO videos (video_id, data) VALUES (?, ?)",
+                        [(video["id"], json.dumps(video)) for video in changed if video["id"] in self._videos]
+                    )
+                    if evicted:
+                        # Also drops stored videos beyond the cap that were never loaded
+                        self._db.execute(
+                            "DELETE FROM videos WHERE rowid NOT IN "
+                            "(SELECT rowid FROM videos ORDER BY rowid DESC LIMIT ?)",
+                            (self.max_videos,)
+                        )
+
+    @timed("local_search")
+    def search(self, query: str, max_results: int = 10, exclude: Iterable[str] = ()) -> List[Dict]:
+        """Return the best BM25 matches for query, skipping the excluded video ids."""
+        terms = set(tokenize(query))
+        excluded = set(exclude)
+        with self._lock:
+            if not self._videos:
+                return []
+            n = len(self._videos)
+            average_length = self._total_length / n
+            scores: Dict[str, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for video_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[video_id] / average_length)
+                    scores[video_id] = scores.get(video_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+            ranked = sorted(
+                (video_id for video_id in scores if video_id not in excluded),
+                key=scores.get,
+                reverse=True
+            )
+            return [self._videos[video_id] for video_id in ranked[:max_results]]
+
+    def close(self) -> None:
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+
+    def _load(self):
+        """Index the most recently stored videos, behind any fetched since start."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM videos ORDER BY rowid DESC LIMIT ?", (self.max_videos,)
+            ).fetchall()
+        # Newest first, each moved to the front, so the oldest end up first in line for eviction
+        for start in range(0, len(rows), 1000):
+            # In chunks, so searches and new videos are not held up for the whole load
+            with self._lock:
+                for (data,) in rows[start:start + 1000]:
+                    if len(self._videos) >= self.max_videos:
+                        return
+                    video = json.loads(data)
+                    # Videos fetched while loading are newer than the stored ones
+                    if video["id"] not in self._videos:
+                        self._index(video)
+                        self._videos.move_to_end(video["id"], last=False)
+
+    def _evict(self) -> List[str]:
+        evicted = []
+        while len(self._videos) > self.max_videos:
+            video_id = next(iter(self._videos))
+            self._unindex(video_id)
+            evicted.append(video_id)
+        return evicted
+
+    def _index(self, video: Dict) -> None:
+        video_id = video["id"]
+        if video_id in self._videos:
+            self._unindex(video_id)
+
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(video.get(field) or ""):
+                terms[term] += weight
+
+        self._videos[video_id] = video
+        self._lengths[video_id] = sum(terms.values())
+        self._total_length += self._lengths[video_id]
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[video_id] = tf
+
+    def _unindex(self, video_id: str) -> None:
+        video = self._videos.pop(video_id)
+        self._total_length -= self._lengths.pop(video_id)
+        for field in FIELD_WEIGHTS:
+            for term in set(tokenize(video.get(field) or "")):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(video_id, None)
+                    if not postings:
+                        del self._postings[term]
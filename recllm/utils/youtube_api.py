@@ -1,20 +1,83 @@
-from typing import List, Dict, Optional
+from typing import Iterable, List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from recllm.utils.response_cache import ResponseCache
+from recllm.utils.video_index import VideoIndex
+from recllm.utils.metrics import API_CALLS, LOCAL_RETRIEVAL, timed
 
 load_dotenv()
 
+# videos().list accepts at most 50 comma-separated ids per call
+MAX_IDS_PER_REQUEST = 50
+
+# "api": live search, falling back to the local index (if any) on quota errors
+# and empty results; "hybrid": additionally adds local index matches to every
+# live search; "local": the local index only, e.g. when running without quota
+RETRIEVAL_MODES = ("api", "hybrid", "local")
+
+# 403 reasons that last until the daily quota resets
+QUOTA_REASONS = (b"quotaExceeded", b"dailyLimitExceeded")
+
 class YouTubeAPI:
-    def __init__(self, api_key: Optional[str] = None):
-        """Initialize YouTube API client."""
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        client=None,
+        max_workers: int = 4,
+        search_cache: Optional[ResponseCache] = None,
+        video_cache: Optional[ResponseCache] = None,
+        video_index: Optional[VideoIndex] = None,
+        retrieval_mode: str = "api",
+        local_results: Optional[int] = None,
+        quota_cooldown_seconds: float = 3600.0
+    ):
+        """Initialize YouTube API client.
+
+        A prebuilt discovery client (e.g. a local fake) can be passed as
+        `client`; otherwise one is built per thread, since the underlying
+        HTTP transport is not thread-safe. Search results and video details
+        are served from the given caches when provided.
+
+        Every fetched video is added to `video_index` when given. Searches
+        use it according to `retrieval_mode` (see RETRIEVAL_MODES), adding
+        up to `local_results` matches (default half of max_results) in
+        hybrid mode. After a quota error, searches are served from the
+        index alone for `quota_cooldown_seconds`, in any mode.
+        """
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"retrieval_mode must be one of {RETRIEVAL_MODES}, got {retrieval_mode!r}")
+        if retrieval_mode != "api" and video_index is None:
+            raise ValueError(f"retrieval_mode {retrieval_mode!r} requires a video index")
+
+        self._client = client
+        self.search_cache = search_cache
+        self.video_cache = video_cache
+        self.video_index = video_index
+        self.retrieval_mode = retrieval_mode
+        self.local_results = local_results
+        self.quota_cooldown_seconds = quota_cooldown_seconds
+        self._quota_exhausted_until = 0.0
+        self._local = threading.local()
+        self.max_workers = max_workers
         self.api_key = api_key or os.getenv("YOUTUBE_API_KEY")
-        if not self.api_key:
+        if client is None and not self.api_key and retrieval_mode != "local":
             raise ValueError("YouTube API key is required")
-        
-        self.youtube = build("youtube", "v3", developerKey=self.api_key)
-    
+
+    @property
+    def youtube(self):
+        """Discovery client for the current thread."""
+        if self._client is not None:
+            return self._client
+        if not hasattr(self._local, "youtube"):
+            self._local.youtube = build("youtube", "v3", developerKey=self.api_key)
+        return self._local.youtube
+
+    @timed("youtube_search")
     def search_videos(
         self,
         query: str,
@@ -22,7 +85,62 @@ class YouTubeAPI:
         region_code: str = "US",
         relevance_language: str = "en"
     ) -> List[Dict]:
-        """Search for videos using the YouTube Data API."""
+        """Search for videos using the YouTube Data API and the local video index.
+
+        With an index, searches fall back to it alone while the quota is
+        exhausted or when the live search returns nothing. In hybrid mode,
+        live results are also followed by further matches from the index.
+        """
+        if self.retrieval_mode == "local":
+            return self._search_local(query, max_results, reason="local")
+        if self.video_index is not None and time.time() < self._quota_exhausted_until:
+            return self._search_local(query, max_results, reason="quota")
+
+        live = self._search_live(query, max_results, region_code, relevance_language)
+        if self.video_index is None:
+            return live
+        if not live:
+            reason = "quota" if time.time() < self._quota_exhausted_until else "empty"
+            return self._search_local(query, max_results, reason=reason)
+        if self.retrieval_mode == "api":
+            return live
+
+        local_results = self.local_results if self.local_results is not None else max_results // 2
+        return live + self._search_local(
+            query,
+            local_results,
+            reason="hybrid",
+            exclude=[video["id"] for video in live]
+        )
+
+    def _search_live(
+        self,
+        query: str,
+        max_results: int,
+        region_code: str,
+        relevance_language: str
+    ) -> List[Dict]:
+        if self.search_cache is None:
+            return self._search_videos(query, max_results, region_code, relevance_language)
+
+        key = "|".join([
+            " ".join(query.lower().split()),
+            region_code,
+            relevance_language,
+            str(max_results)
+        ])
+        return self.search_cache.get_or_fetch(
+            key,
+            lambda: self._search_videos(query, max_results, region_code, relevance_language)
+        )
+
+    def _search_videos(
+        self,
+        query: str,
+        max_results: int,
+        region_code: str,
+        relevance_language: str
+    ) -> List[Dict]:
         # TODO: Hybridise with Filmot API subtitle search
         try:
             search_response = self.youtube.search().list(
@@ -33,61 +151,141 @@ class YouTubeAPI:
                 regionCode=region_code,
                 relevanceLanguage=relevance_language
             ).execute()
-            
-            videos = []
-            for item in search_response.get("items", []):
-                video_id = item["id"]["videoId"]
-                
-                # Get additional video details
-                video_response = self.youtube.videos().list(
-                    part="snippet,statistics,contentDetails",
-                    id=video_id
-                ).execute()
-                
-                if video_response["items"]:
-                    video_data = video_response["items"][0]
-                    videos.append({
-                        "id": video_id,
-                        "title": video_data["snippet"]["title"],
-                        "description": video_data["snippet"]["description"],
-                        "thumbnail": video_data["snippet"]["thumbnails"]["medium"]["url"],
-                        "channel_title": video_data["snippet"]["channelTitle"],
-                        "published_at": video_data["snippet"]["publishedAt"],
-                        "view_count": video_data["statistics"].get("viewCount", "0"),
-                        "like_count": video_data["statistics"].get("likeCount", "0"),
-                        "duration": video_data["contentDetails"]["duration"]
-                    })
-            
-            return videos
-            
+            API_CALLS.inc(method="search.list", status="ok")
+
+            video_ids = [
+                item["id"]["videoId"]
+                for item in search_response.get("items", [])
+            ]
+
+            # Get additional video details in bulk, keeping search order
+            details = self.get_video_details_many(video_ids)
+            return [details[video_id] for video_id in video_ids if video_id in details]
+
         except HttpError as e:
+            API_CALLS.inc(method="search.list", status=str(e.resp.status))
+            self._check_quota(e)
             print(f"An HTTP error {e.resp.status} occurred: {e.content}")
             return []
-    
+
+    def _search_local(self, query: str, max_results: int, reason: str, exclude: Iterable[str] = ()) -> List[Dict]:
+        results = self.video_index.search(query, max_results, exclude=exclude) if max_results > 0 else []
+        if results:
+            LOCAL_RETRIEVAL.inc(reason=reason)
+        return results
+
+    def _check_quota(self, error: HttpError) -> None:
+        """Switch searches to the local index for a while after a quota error."""
+        if error.resp.status == 403 and any(reason in (error.content or b"") for reason in QUOTA_REASONS):
+            self._quota_exhausted_until = time.time() + self.quota_cooldown_seconds
+
+    def search_videos_many(self, queries: List[str], **search_kwargs) -> List[List[Dict]]:
+        """Run several searches concurrently, returning results in query order."""
+        if len(queries) <= 1:
+            return [self.search_videos(query, **search_kwargs) for query in queries]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(queries))) as pool:
+            return list(pool.map(lambda query: self.search_videos(query, **search_kwargs), queries))
+
     def get_video_details(self, video_id: str) -> Optional[Dict]:
         """Get detailed information about a specific video."""
+        return self.get_video_details_many([video_id]).get(video_id)
+
+    @timed("youtube_video_details")
+    def get_video_details_many(self, video_ids: List[str]) -> Dict[str, Dict]:
+        """Get details for many videos, keyed by id, in as few API calls as possible.
+
+        Ids are de-duplicated and fetched in chunks of 50; chunks run
+        concurrently when there is more than one.
+        """
+        unique_ids = list(dict.fromkeys(video_ids))
+        if self.video_cache is None:
+            return self._fetch_video_details_many(unique_ids)
+
+        details, missing, stale = {}, [], []
+        for video_id in unique_ids:
+            cached, fresh = self.video_cache.lookup(video_id)
+            if cached is None:
+                missing.append(video_id)
+                continue
+            details[video_id] = cached
+            if not fresh:
+                stale.append(video_id)
+
+        if stale:
+            self.video_cache.revalidate(
+                tuple(stale),
+                lambda: self._cache_video_details(self._fetch_video_details_many(stale))
+            )
+        if missing:
+            fetched = self._fetch_video_details_many(missing)
+            self._cache_video_details(fetched)
+            details.update(fetched)
+
+        return details
+
+    def cache_stats(self) -> Dict[str, Dict]:
+        """Return hit/miss counters of the search and video caches, and the index size."""
+        return {
+            "search": self.search_cache.stats() if self.search_cache else {},
+            "videos": self.video_cache.stats() if self.video_cache else {},
+            "video_index": {"videos": len(self.video_index)} if self.video_index is not None else {}
+        }
+
+    def _cache_video_details(self, details: Dict[str, Dict]) -> None:
+        for video_id, video in details.items():
+            self.video_cache.set(video_id, video)
+
+    def _fetch_video_details_many(self, unique_ids: List[str]) -> Dict[str, Dict]:
+        chunks = [
+            unique_ids[start:start + MAX_IDS_PER_REQUEST]
+            for start in range(0, len(unique_ids), MAX_IDS_PER_REQUEST)
+        ]
+
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as pool:
+                results = list(pool.map(self._fetch_video_details, chunks))
+        else:
+            results = [self._fetch_video_details(chunk) for chunk in chunks]
+
+        details = {}
+        for result in results:
+            details.update(result)
+        if self.video_index is not None and details:
+            self.video_index.add_many(details.values())
+        return details
+
+    def _fetch_video_details(self, video_ids: List[str]) -> Dict[str, Dict]:
+        """Fetch one chunk of at most 50 videos with a single videos().list call."""
         try:
             video_response = self.youtube.videos().list(
                 part="snippet,statistics,contentDetails",
-                id=video_id
+                id=",".join(video_ids)
             ).execute()
-            
-            if video_response["items"]:
-                video_data = video_response["items"][0]
-                return {
-                    "id": video_id,
-                    "title": video_data["snippet"]["title"],
-                    "description": video_data["snippet"]["description"],
-                    "thumbnail": video_data["snippet"]["thumbnails"]["medium"]["url"],
-                    "channel_title": video_data["snippet"]["channelTitle"],
-                    "published_at": video_data["snippet"]["publishedAt"],
-                    "view_count": video_data["statistics"].get("viewCount", "0"),
-                    "like_count": video_data["statistics"].get("likeCount", "0"),
-                    "duration": video_data["contentDetails"]["duration"]
-                }
-            
-            return None
-            
+            API_CALLS.inc(method="videos.list", status="ok")
+
+            return {
+                item["id"]: self._parse_video(item)
+                for item in video_response.get("items", [])
+            }
+
         except HttpError as e:
+            API_CALLS.inc(method="videos.list", status=str(e.resp.status))
+            self._check_quota(e)
             print(f"An HTTP error {e.resp.status} occurred: {e.content}")
-            return None 
\ No newline at end of file
+            return {}
+
+    @staticmethod
+    def _parse_video(video_data: Dict) -> Dict:
+        """Flatten a videos().list item into the video dict used across RecLLM."""
+        return {
+            "id": video_data["id"],
+            "title": video_data["snippet"]["title"],
+            "description": video_data["snippet"]["description"],
+            "thumbnail": video_data["snippet"]["thumbnails"]["medium"]["url"],
+            "channel_title": video_data["snippet"]["channelTitle"],
+            "published_at": video_data["snippet"]["publishedAt"],
+            "view_count": video_data["statistics"].get("viewCount", "0"),
+            "like_count": video_data["statistics"].get("likeCount", "0"),
+            "duration": video_data["contentDetails"]["duration"]
+        }